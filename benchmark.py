@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import math
+import mmap
+import time
+import shutil
+import random
+import asyncio
+import zipfile
+import tempfile
+import argparse
+import platform
+import threading
+import subprocess
+import statistics
+import zip_utils
+import zip_shrink
+import zip_repack
+import block_store
+
+# 下载相关的测试需要 aiohttp
+try:
+    from aiohttp import web
+    import downloader
+except ImportError:
+    web = None
+
+'''
+性能基准测试
+
+    1. 生成两个版本的模拟安装包（文件数、大小分布、stored/deflated 比例、版本间变化比例可配置）
+       相同参数生成的包完全一致，可以在不同提交之间对比
+    2. 测量 get_file_infos、shrink（首次和增量）、repack、parse_shrink_package 的耗时
+    3. 用 unpacker.py 生成 upload 目录，启动本地块服务器（模拟 CDN，延迟和带宽可配置），
+       测量 downloader.py 完整流程的耗时（首次下载 v1，之后基于 v1 的缓存下载 v2）
+    4. 结果写出为 JSON
+
+用法
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json
+'''
+
+# 模拟包中文件的修改时间（固定，保证生成的包一致）
+date_time = (2022, 1, 1, 0, 0, 0)
+# deflated 文件的内容只使用 16 个字符，压缩率接近真实的文本资源
+text_table = bytes(b'abcdefghijklmnop'[x % 16] for x in range(256))
+# 块服务器发送数据的分段大小
+send_size = 64 * 1024
+
+
+def log(message):
+    # 结果可以输出到 stdout，进度信息统一输出到 stderr
+    print(message, file=sys.stderr)
+
+
+def gen_specs(args):
+    ''' 文件列表 [(文件名, 大小, 是否 stored), ...]，大小服从对数正态分布 '''
+    rnd = random.Random(args.seed)
+    specs = []
+    for i in range(args.entries):
+        size = int(rnd.lognormvariate(math.log(args.size_median),
+                                      args.size_sigma))
+        size = max(1, min(size, args.max_size))
+        stored = rnd.random() < args.stored_ratio
+        name = ('assets/%05d.bin' if stored else 'res/%05d.xml') % i
+        specs.append((name, size, stored))
+    return specs
+
+
+def gen_content(seed, size, stored):
+    rnd = random.Random(seed)
+    data = rnd.randbytes(size)
+    if not stored:
+        data = data.translate(text_table)
+    return data
+
+
+def gen_package(path, specs, seed, churn, version):
+    ''' 生成第 version 个版本的模拟包（每个版本每个文件以 churn 的概率变化） '''
+    with zipfile.ZipFile(path, 'w') as z:
+        for i, (name, size, stored) in enumerate(specs):
+            # 最后一次变化的版本决定文件内容
+            changed = 0
+            for v in range(1, version + 1):
+                if random.Random('%d-%d-%d' % (seed, i, v)).random() < churn:
+                    changed = v
+            data = gen_content('%d-%d-%d' % (seed, i, changed), size, stored)
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_STORED if stored else \
+                zipfile.ZIP_DEFLATED
+            z.writestr(info, data)
+
+
+def summarize(times):
+    ''' 耗时统计（秒） '''
+    return {
+        'times': [round(x, 6) for x in times],
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+    }
+
+
+def measure(func, repeat):
+    ''' 重复执行 func，返回耗时统计 '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def with_throughput(result, size):
+    result['bytes'] = size
+    result['mb_per_s'] = round(size / max(result['min'], 1e-9) / 2 ** 20, 2)
+    return result
+
+
+def reset_folder(folder):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+
+def bench_parse(pkg_path, repeat):
+    with open(pkg_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return measure(lambda: zip_utils.get_file_infos(mm), repeat)
+    finally:
+        mm.close()
+
+
+def bench_shrink(work, v1, v2, repeat, workers):
+    ''' 首次 shrink v1，以及在 v1 的块存储上增量 shrink v2 '''
+    blocks = os.path.join(work, 'bench_blocks')
+    shrink_v1 = os.path.join(work, 'v1.shrink')
+    shrink_v2 = os.path.join(work, 'v2.shrink')
+
+    cold = []
+    incremental = []
+    for i in range(repeat):
+        reset_folder(blocks)
+        store = block_store.get_store(blocks)
+        for src, dst, times in ((v1, shrink_v1, cold),
+                                (v2, shrink_v2, incremental)):
+            start = time.perf_counter()
+            zip_shrink.shrink(src, dst, store, workers=workers)
+            times.append(time.perf_counter() - start)
+
+    results = {}
+    for key, times, path in (('shrink', cold, v1),
+                             ('shrink_incremental', incremental, v2)):
+        results[key] = with_throughput(summarize(times),
+                                       os.path.getsize(path))
+
+    store = block_store.get_store(blocks)
+    results['repack'] = with_throughput(measure(
+        lambda: zip_repack.repack(shrink_v1, os.devnull, store), repeat),
+        os.path.getsize(v1))
+
+    if web != None:
+        with open(shrink_v1, 'rb') as f:
+            buffer = f.read()
+        empty = os.path.join(work, 'bench_empty')
+        reset_folder(empty)
+        empty_store = block_store.get_store(empty)
+        results['parse_shrink_package'] = measure(
+            lambda: downloader.parse_shrink_package(buffer, empty_store),
+            repeat)
+    return results
+
+
+def parse_ranges(value, size):
+    ''' 解析 Range（单段或多段），返回 [(start, end), ...]（不含 end），不合法时返回 None '''
+    if not value.startswith('bytes='):
+        return None
+    ranges = []
+    for item in value[len('bytes='):].split(','):
+        start, sep, end = item.strip().partition('-')
+        try:
+            if start == '':
+                # bytes=-500 末尾 500 字节
+                start, end = max(size - int(end), 0), size
+            else:
+                start = int(start)
+                end = size if end == '' else min(int(end) + 1, size)
+        except ValueError:
+            return None
+        if start >= end:
+            return None
+        ranges.append((start, end))
+    return ranges
+
+
+class BlockServer(object):
+    ''' 本地块服务器，模拟 CDN
+        每个请求先等待 latency 秒，所有连接共享 bandwidth 字节/秒的带宽（0 为不限速），
+        支持单段和多段 Range 请求
+    '''
+
+    def __init__(self, root, latency=0, bandwidth=0):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # 令牌桶：下一次可以发送数据的时间
+        self.next_send = 0
+        self.requests = 0
+        self.bytes = 0
+        self.port = None
+
+    def reset_stats(self):
+        self.requests = 0
+        self.bytes = 0
+
+    async def throttle(self, size):
+        self.bytes += size
+        if self.bandwidth <= 0:
+            return
+        now = time.monotonic()
+        self.next_send = max(self.next_send, now) + size / self.bandwidth
+        await asyncio.sleep(self.next_send - now)
+
+    async def send(self, response, data):
+        view = memoryview(data)
+        for i in range(0, len(view), send_size):
+            piece = view[i:i+send_size]
+            await self.throttle(len(piece))
+            await response.write(piece)
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        path = os.path.join(self.root, request.match_info['path'])
+        if not os.path.isfile(path):
+            return web.Response(status=404)
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = len(data)
+
+        ranges = None
+        value = request.headers.get('Range')
+        if value != None:
+            ranges = parse_ranges(value, size)
+            if ranges == None:
+                return web.Response(
+                    status=416, headers={'Content-Range': 'bytes */%d' % size})
+
+        response = web.StreamResponse(status=200 if ranges == None else 206)
+        if ranges == None:
+            body = data
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            body = data[start:end]
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end - 1, size)
+        else:
+            boundary = 'benchmark-boundary'
+            parts = []
+            for start, end in ranges:
+                parts.append(('--%s\r\nContent-Type: application/octet-stream'
+                              '\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                              (boundary, start, end - 1, size)).encode())
+                parts.append(data[start:end])
+                parts.append(b'\r\n')
+            parts.append(('--%s--\r\n' % boundary).encode())
+            body = b''.join(parts)
+            response.headers['Content-Type'] = \
+                'multipart/byteranges; boundary=' + boundary
+
+        response.content_length = len(body)
+        await response.prepare(request)
+        await self.send(response, body)
+        await response.write_eof()
+        return response
+
+    def start(self):
+        ''' 在后台线程中运行，返回端口 '''
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        async def run():
+            app = web.Application()
+            app.router.add_get('/{path:.*}', self.handle)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            self.port = self.runner.addresses[0][1]
+            started.set()
+
+        def main():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(run())
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=main, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def run_unpacker(work, pkg_path, name, unpack_args):
+    ''' 用 unpacker.py 生成 upload 目录（与线上一致，可以带 --bundle、--codec 等参数） '''
+    command = [sys.executable, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'unpacker.py'), pkg_path, '--no-clean',
+        '--blocks-only', '--shrink-pkg-name', name] + unpack_args
+    subprocess.run(command, cwd=work, check=True, stdout=subprocess.DEVNULL)
+
+
+def run_downloader(url, cache, output, downloader_args):
+    command = [sys.executable, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'downloader.py'), url, '-c', cache,
+        '-o', output] + downloader_args
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def bench_download(work, v1, v2, args):
+    ''' 首次下载 v1，基于 v1 的缓存下载 v2 '''
+    upload = os.path.join(work, 'upload')
+    if os.path.exists(upload):
+        shutil.rmtree(upload)
+    unpack_args = args.unpack_args.split()
+    run_unpacker(work, v1, 'v1', unpack_args)
+    run_unpacker(work, v2, 'v2', unpack_args)
+
+    server = BlockServer(upload, args.latency / 1000.0,
+                         args.bandwidth * 2 ** 20)
+    port = server.start()
+    base_url = 'http://127.0.0.1:%d/pkgs/' % port
+
+    cache = os.path.join(work, 'bench_cache')
+    output = os.path.join(work, 'bench_out.zip')
+    downloader_args = args.downloader_args.split()
+    stats = {'download': [], 'download_incremental': []}
+    try:
+        for i in range(args.repeat):
+            reset_folder(cache)
+            for key, name, src in (('download', 'v1', v1),
+                                   ('download_incremental', 'v2', v2)):
+                server.reset_stats()
+                elapsed = run_downloader(base_url + name + '.zip', cache,
+                                         output, downloader_args)
+                if not same_file(output, src):
+                    raise Exception('downloaded package not match: ' + name)
+                stats[key].append((elapsed, server.requests, server.bytes))
+    finally:
+        server.stop()
+
+    results = {}
+    for key, runs in stats.items():
+        results[key] = summarize([x[0] for x in runs])
+        results[key]['requests'] = runs[-1][1]
+        results[key]['bytes_served'] = runs[-1][2]
+    return results
+
+
+def same_file(path1, path2):
+    ''' 逐段比较两个文件是否一致 '''
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            data = f1.read(1024 * 1024)
+            if data != f2.read(1024 * 1024):
+                return False
+            if not data:
+                return True
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    work = args.work or tempfile.mkdtemp(prefix='iph-bench-')
+    if not os.path.exists(work):
+        os.makedirs(work)
+    work = os.path.abspath(work)
+
+    specs = gen_specs(args)
+    v1 = os.path.join(work, 'v1.zip')
+    v2 = os.path.join(work, 'v2.zip')
+    start = time.perf_counter()
+    gen_package(v1, specs, args.seed, args.churn, 1)
+    gen_package(v2, specs, args.seed, args.churn, 2)
+    log('generated packages in %.1fs => %s' %
+        (time.perf_counter() - start, work))
+    packages = {
+        'entries': len(specs),
+        'extracted': sum(1 for x in specs if x[1] > zip_utils.threshold),
+        'v1_size': os.path.getsize(v1),
+        'v2_size': os.path.getsize(v2),
+    }
+
+    results = {}
+    try:
+        results['get_file_infos'] = bench_parse(v1, args.repeat)
+        results.update(bench_shrink(work, v1, v2, args.repeat, args.jobs))
+        if args.skip_download:
+            pass
+        elif web == None:
+            log('aiohttp not installed, skip download benchmark')
+        else:
+            results.update(bench_download(work, v1, v2, args))
+    finally:
+        if args.work == None and not args.keep:
+            shutil.rmtree(work)
+
+    return {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'packages': packages,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='result json path, - for stdout')
+    parser.add_argument('--repeat', type=int, default=3, help='repeat times')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='shrink threads')
+    parser.add_argument('--work', help='work folder (kept after run), '
+                        'default a temporary folder')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary work folder')
+
+    package_group = parser.add_argument_group('synthetic package')
+    package_group.add_argument('--seed', type=int, default=1,
+                               help='random seed')
+    package_group.add_argument('--entries', type=int, default=1000,
+                               help='entry count')
+    package_group.add_argument('--size-median', type=int, default=8192,
+                               help='median entry size')
+    package_group.add_argument('--size-sigma', type=float, default=2.0,
+                               help='sigma of log entry size')
+    package_group.add_argument('--max-size', type=int,
+                               default=64 * 1024 * 1024, help='max entry size')
+    package_group.add_argument('--stored-ratio', type=float, default=0.3,
+                               help='ratio of stored entries')
+    package_group.add_argument('--churn', type=float, default=0.05,
+                               help='ratio of entries changed between versions')
+
+    download_group = parser.add_argument_group('download')
+    download_group.add_argument('--skip-download', action='store_true',
+                                help='skip downloader benchmark')
+    download_group.add_argument('--latency', type=float, default=20,
+                                help='block server latency per request (ms)')
+    download_group.add_argument('--bandwidth', type=float, default=50,
+                                help='block server bandwidth (MB/s), '
+                                '0 for unlimited')
+    download_group.add_argument('--unpack-args', default='',
+                                help='extra unpacker.py arguments')
+    download_group.add_argument('--downloader-args', default='',
+                                help='extra downloader.py arguments')
+    args = parser.parse_args()
+
+    result = json.dumps(run(args), indent=2)
+    if args.output == '-':
+        print(result)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(result)
+        log('result => ' + args.output)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+
+
+# 不超过该大小的块会打包到 bundle 中
+max_block_size = 64 * 1024
+# 单个 bundle 文件大小上限
+bundle_size = 4 * 1024 * 1024
+
+'''
+每个精简包对应的 bundle 文件，与精简包放在同一目录
+    <精简包>.bundles            索引
+    <精简包>.bundle-<序号>       按偏移顺序拼接的小块内容
+
+索引格式
+    {
+        "bundles": [[文件名, 大小], ...],
+        "blocks": {hash: [bundle 序号, 偏移, 长度], ...}
+    }
+
+loose 块仍然照常写入 blocks 目录，旧客户端不受影响
+'''
+
+
+def index_path(shrink_pkg_path):
+    return shrink_pkg_path + '.bundles'
+
+
+def write_bundles(shrink_pkg_path, store, hashes):
+    ''' 将精简包引用的小块拼接为 bundle 文件，并写入索引
+    Args:
+        shrink_pkg_path: 精简后的 zip 包路径
+        store:           块存储
+        hashes:          需要打包的块 hash（按偏移顺序，不重复）
+    Returns:
+        索引
+    '''
+
+    folder, name = os.path.split(shrink_pkg_path)
+    index = {'bundles': [], 'blocks': {}}
+    view = memoryview(bytearray(max_block_size))
+
+    dst = None
+    for hash in hashes:
+        size = store.size(hash)
+        if dst == None or dst.tell() + size > bundle_size:
+            if dst != None:
+                index['bundles'][-1][1] = dst.tell()
+                dst.close()
+            bundle_name = '%s.bundle-%d' % (name, len(index['bundles']))
+            index['bundles'].append([bundle_name, 0])
+            dst = open(os.path.join(folder, bundle_name), 'wb')
+
+        index['blocks'][hash] = [len(index['bundles']) - 1, dst.tell(), size]
+        for data in store.iter_data(hash, view):
+            dst.write(data)
+
+    if dst != None:
+        index['bundles'][-1][1] = dst.tell()
+        dst.close()
+
+    with open(index_path(shrink_pkg_path), 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+    return index
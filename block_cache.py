@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import struct
+import block_store
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+'''
+客户端块缓存的访问记录和容量限制
+
+缓存目录下
+    .access     访问记录，追加写入的定长记录，同一个块以最后一条为准
+                0   md5                     16 bytes
+                1   访问时间                 8 bytes (double)
+    .lock       多个 downloader 进程共用缓存目录时的文件锁
+                下载期间持有共享锁，淘汰时需要独占锁，有其他进程正在下载时跳过淘汰，
+                保证其他进程正在使用的块不会被删除
+
+超出容量时按最后访问时间淘汰，当前包引用的块不会被淘汰
+'''
+
+access_name = '.access'
+lock_name = '.lock'
+
+
+class CacheTracker(object):
+    record = struct.Struct('<16sd')
+
+    def __init__(self, folder, pack=False):
+        ''' 持有共享锁后再加载块存储（self.store），加载的索引不会被其他进程的淘汰改变 '''
+        self.lock_file = open(os.path.join(folder, lock_name), 'a+b')
+        if fcntl != None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+
+        self.store = block_store.get_store(folder, pack=pack)
+        self.access_path = os.path.join(folder, access_name)
+        # 当前包引用的块（不会被淘汰）
+        self.touched = set()
+        # 尚未写入访问记录的块
+        self.pending = set()
+
+    def close(self):
+        self.lock_file.close()
+
+    def touch(self, hash):
+        if hash not in self.touched:
+            self.touched.add(hash)
+            self.pending.add(hash)
+
+    def touch_entry(self, hash):
+        ''' 记录文件内容的访问（分块存储时记录所有分块） '''
+        self.touch(hash)
+        if hash not in self.store:
+            for h, size in block_store.read_recipe(self.store, hash) or []:
+                self.touch(h)
+
+    def flush(self):
+        ''' 写入访问记录 '''
+        if not self.pending:
+            return
+        now = time.time()
+        block_store.append_records(self.access_path, b''.join(
+            self.record.pack(bytes.fromhex(hash), now)
+            for hash in self.pending))
+        self.pending.clear()
+
+    def load_access(self):
+        ''' hash -> 最后访问时间 '''
+        access = {}
+        if os.path.exists(self.access_path):
+            for digest, t in block_store.read_records(self.access_path,
+                                                      self.record):
+                access[digest.hex()] = t
+        return access
+
+    def evict(self, max_size):
+        ''' 淘汰最久未访问的块，直到缓存不超过 max_size
+        Returns:
+            (淘汰的块数, 释放的字节数)，其他进程正在使用缓存时返回 None
+        '''
+
+        self.flush()
+        if fcntl != None:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # flock 升级不是原子操作，失败时可能已释放共享锁，重新获取
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+                return None
+
+        try:
+            # 重新加载索引，包含其他进程写入的块
+            store = block_store.get_store(self.store.folder)
+            access = self.load_access()
+
+            total = sum(store.size(hash) for hash in store.blocks)
+            freed = 0
+            removed = set()
+            candidates = sorted(
+                (hash for hash in store.blocks if hash not in self.touched),
+                key=lambda hash: access.get(hash, 0))
+            for hash in candidates:
+                if total - freed <= max_size:
+                    break
+                freed += store.size(hash)
+                store.remove(hash)
+                removed.add(hash)
+
+            if removed:
+                self.remove_recipes(store, removed)
+                if isinstance(store, block_store.PackStore):
+                    store.compact()
+
+            # 重写访问记录，清理已删除的块
+            block_store.replace_file(self.access_path, b''.join(
+                self.record.pack(bytes.fromhex(hash), t)
+                for hash, t in access.items() if hash in store.blocks))
+
+            return len(removed), freed
+        finally:
+            if fcntl != None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+
+    def remove_recipes(self, store, removed):
+        ''' 删除引用了已淘汰分块的分块清单 '''
+        for name in os.listdir(store.folder):
+            if not name.endswith(block_store.recipe_ext):
+                continue
+            hash = name[:-len(block_store.recipe_ext)]
+            if hash in self.touched:
+                continue
+            chunks = block_store.read_recipe(store, hash) or []
+            if any(h in removed for h, size in chunks):
+                os.remove(os.path.join(store.folder, name))
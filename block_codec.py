@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zlib
+import lzma
+import struct
+import hashlib
+
+'''
+块编码，未压缩（stored）的文件内容可以压缩后存储和传输
+
+编码后的块
+0   magic b'IPHB'                   4 bytes
+1   编码方式                        1 byte
+2   原始大小                        8 bytes
+3   编码后的数据
+
+不带 magic 的块为原始内容；原始内容恰好以 magic 开头时，总是以 none 方式编码，保证不会误判
+块仍以原始内容的 md5 命名
+'''
+
+magic = b'IPHB'
+header = struct.Struct('<4sBQ')
+
+# 编码方式
+codecs = ['none', 'zlib', 'lzma']
+
+# 写入块时使用的编码方式，None 表示不压缩
+codec = None
+# 压缩后不小于原始大小的该比例时，保存原始内容
+max_ratio = 0.9
+# 解码时每次输出的最大长度
+out_size = 1024 * 1024
+
+
+def compress(data, name):
+    if name == 'zlib':
+        return zlib.compress(data, 9)
+    if name == 'lzma':
+        return lzma.compress(data)
+    raise ValueError('unknown codec: ' + name)
+
+
+def encode(data, compressed=True):
+    ''' 编码块内容
+    Args:
+        data:       原始内容
+        compressed: 是否按 codec 压缩（已压缩的内容传 False）
+    '''
+
+    if compressed and codec != None:
+        out = compress(data, codec)
+        if header.size + len(out) < len(data) * max_ratio:
+            return header.pack(magic, codecs.index(codec), len(data)) + out
+
+    if data[:len(magic)] != magic:
+        return data
+    return header.pack(magic, 0, len(data)) + bytes(data)
+
+
+class Decoder(object):
+    ''' 流式解码，分段输入编码后的块内容，分段输出原始内容 '''
+
+    def __init__(self):
+        self.head = b''
+        # None: 未读到头部，'raw': 原始内容
+        self.codec = None
+        self.decompressor = None
+        self.size = 0
+        self.decoded = 0
+
+    def begin(self, data):
+        ''' 读取头部，返回头部之后的数据 '''
+        if self.head or len(data) < header.size:
+            self.head += data
+            if len(self.head) < header.size:
+                return b''
+            data, self.head = self.head, b''
+
+        if data[:len(magic)] != magic:
+            self.codec = 'raw'
+            return data
+
+        m, codec_id, self.size = header.unpack_from(data)
+        if codec_id >= len(codecs):
+            raise ValueError('unknown codec: %d' % codec_id)
+        self.codec = codecs[codec_id]
+        if self.codec == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        elif self.codec == 'lzma':
+            self.decompressor = lzma.LZMADecompressor()
+        return memoryview(data)[header.size:]
+
+    def decode(self, data):
+        ''' 解码一段数据
+        Yields:
+            原始内容（每段不超过 out_size）
+        '''
+
+        if self.codec == None:
+            data = self.begin(data)
+            if self.codec == None:
+                return
+
+        if self.decompressor == None:
+            if len(data) > 0:
+                self.decoded += len(data)
+                yield data
+            return
+
+        d = self.decompressor
+        out = d.decompress(data, out_size)
+        while True:
+            if out:
+                self.decoded += len(out)
+                yield out
+            if self.codec == 'zlib':
+                if not d.unconsumed_tail:
+                    break
+                out = d.decompress(d.unconsumed_tail, out_size)
+            else:
+                if d.needs_input or d.eof:
+                    break
+                out = d.decompress(b'', out_size)
+
+    def finish(self):
+        ''' 输入结束，返回剩余的原始内容（不足头部大小的原始块） '''
+        if self.codec == None:
+            # 块小于头部大小，只可能是原始内容
+            self.codec = 'raw'
+            self.decoded += len(self.head)
+            return self.head
+        if self.codec != 'raw' and self.decoded != self.size:
+            raise ValueError('decoded size not match')
+        return b''
+
+
+def iter_decode(pieces):
+    ''' 解码分段读取的块内容 '''
+    decoder = Decoder()
+    for data in pieces:
+        yield from decoder.decode(data)
+    data = decoder.finish()
+    if data:
+        yield data
+
+
+def decode(data):
+    ''' 解码整个块 '''
+    return b''.join(iter_decode([data]))
+
+
+def get_md5(pieces):
+    ''' 计算块原始内容的 md5
+    Args:
+        pieces: 分段的块内容
+    '''
+    m = hashlib.md5()
+    for data in iter_decode(pieces):
+        m.update(data)
+    return m.hexdigest()
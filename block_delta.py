@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import lzma
+import mmap
+import struct
+import hashlib
+import zip_utils
+import chunker
+import block_store
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 超过该大小的文件才生成差量（小文件通过 bundle 下载）
+min_size = 64 * 1024
+# 差量小于完整块的该比例时才发布
+max_ratio = 0.5
+
+'''
+相对基准构建的差量块，客户端已缓存基准构建中同名文件的内容时，只需下载差量
+只处理未压缩（stored）的文件，deflate 后的数据一处修改会导致后续字节全部变化，差量没有效果
+
+差量文件放在 upload/deltas 目录下
+    <基准内容 md5>-<新内容 md5>
+
+每个精简包对应一个索引，与精简包放在同一目录
+    <精简包>.deltas
+    {"deltas": {新内容 hash: [基准内容 hash, 差量大小], ...}}
+
+差量格式（类似 rsync，按小分块匹配基准内容）
+    b'IPHD' + lzma 压缩的指令序列
+    COPY    b'C' + 基准中的偏移 (8 bytes) + 长度 (8 bytes)
+    INSERT  b'I' + 长度 (8 bytes) + 数据
+'''
+
+magic = b'IPHD'
+copy_op = struct.Struct('<cQQ')
+insert_op = struct.Struct('<cQ')
+
+
+def should_delta(f_info):
+    ''' 文件内容是否需要生成差量 '''
+    return f_info.method == 0 and f_info.compressed_size > min_size
+
+# 匹配基准内容使用的分块，比存储分块小得多，修改处附近的未变化内容也能匹配上
+delta_chunker = chunker.Chunker(512, 2048, 8192, 11, 8)
+
+
+def delta_name(base_hash, hash):
+    return '%s-%s' % (base_hash, hash)
+
+
+def index_path(shrink_pkg_path):
+    return shrink_pkg_path + '.deltas'
+
+
+def make_delta(base, data):
+    ''' 生成 data 相对 base 的差量 '''
+
+    base = memoryview(base)
+    data = memoryview(data)
+
+    # 基准内容中各分块的位置
+    known = {}
+    for start, end in delta_chunker.split(base):
+        known.setdefault(hashlib.md5(base[start:end]).digest(), start)
+
+    # [指令, 偏移, 长度]，相邻的同类指令合并
+    ops = []
+    for start, end in delta_chunker.split(data):
+        size = end - start
+        offset = known.get(hashlib.md5(data[start:end]).digest())
+        if offset == None:
+            kind, offset = b'I', start
+        else:
+            kind = b'C'
+        if ops and ops[-1][0] == kind and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1][2] += size
+        else:
+            ops.append([kind, offset, size])
+
+    compressor = lzma.LZMACompressor()
+    parts = [magic]
+    for kind, offset, size in ops:
+        if kind == b'C':
+            parts.append(compressor.compress(copy_op.pack(kind, offset, size)))
+        else:
+            parts.append(compressor.compress(insert_op.pack(kind, size)))
+            parts.append(compressor.compress(data[offset:offset+size]))
+    parts.append(compressor.flush())
+    return b''.join(parts)
+
+
+def apply_delta(base, delta):
+    ''' 由基准内容和差量恢复新内容 '''
+
+    if delta[:len(magic)] != magic:
+        raise ValueError('bad delta')
+    ops = memoryview(lzma.decompress(delta[len(magic):]))
+
+    out = bytearray()
+    pos = 0
+    while pos < len(ops):
+        kind = ops[pos:pos+1]
+        if kind == b'C':
+            kind, offset, size = copy_op.unpack_from(ops, pos)
+            pos += copy_op.size
+            if offset + size > len(base):
+                raise ValueError('bad delta')
+            out += base[offset:offset+size]
+        elif kind == b'I':
+            kind, size = insert_op.unpack_from(ops, pos)
+            pos += insert_op.size
+            out += ops[pos:pos+size]
+            pos += size
+        else:
+            raise ValueError('bad delta')
+    return bytes(out)
+
+
+def read_entry(store, hash):
+    ''' 从存储中读取整个文件内容 '''
+    data = bytearray()
+    view = memoryview(bytearray(1024 * 1024))
+    for x in block_store.iter_entry_data(store, hash, view):
+        data += x
+    return data
+
+
+def write_deltas(shrink_pkg_path, deltas_folder, store, base_pkg_path,
+                 entries, workers=1):
+    ''' 为相对基准构建有修改的文件生成差量，并写入索引
+    Args:
+        shrink_pkg_path: 精简后的 zip 包路径
+        deltas_folder:   差量文件目录
+        store:           块存储
+        base_pkg_path:   基准构建的原始包路径
+        entries:         新包中需要生成差量的文件 {文件名: 内容 hash}
+        workers:         生成差量的线程数（lzma 压缩时会释放 GIL）
+    Returns:
+        索引
+    '''
+
+    if not os.path.exists(deltas_folder):
+        os.makedirs(deltas_folder)
+
+    with open(base_pkg_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def make(f, hash):
+        offset = f.header_offset + zip_utils.get_header_len(mm, f.header_offset)
+        base = mm[offset:offset+f.compressed_size]
+        base_hash = hashlib.md5(base).hexdigest()
+        if base_hash == hash:
+            return None
+
+        data = read_entry(store, hash)
+        path = os.path.join(deltas_folder, delta_name(base_hash, hash))
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+        else:
+            delta = make_delta(base, data)
+            size = len(delta)
+            if size >= len(data) * max_ratio:
+                return None
+            block_store.replace_file(path, delta)
+        return hash, base_hash, size
+
+    try:
+        # 同名且内容有变化的文件（内容相同的只生成一次）
+        tasks = {}
+        for f in zip_utils.get_file_infos(mm):
+            hash = entries.get(f.name)
+            if should_delta(f) and hash != None:
+                tasks.setdefault(hash, f)
+
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(make, tasks.values(), tasks.keys()))
+    finally:
+        mm.close()
+
+    index = {'deltas': {}}
+    for result in results:
+        if result != None:
+            hash, base_hash, size = result
+            index['deltas'][hash] = [base_hash, size]
+
+    with open(index_path(shrink_pkg_path), 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+    return index
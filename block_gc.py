@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import zip_utils
+import zip_repack
+import block_store
+import block_bundle
+import block_delta
+import pkg_manifest
+
+'''
+upload 目录的垃圾回收（标记-清除）
+
+    1. 按保留策略（每个分支保留最近 N 个构建，或保留一定天数内的构建）确定保留的精简包
+    2. 解析保留的精简包，标记引用的块（分块存储的文件内容同时标记分块清单和各分块）
+       以及 .deltas 索引引用的差量文件
+    3. 删除过期的精简包及其附属文件，删除未被标记的块、分块清单和差量文件
+
+每个精简包引用的块记录在 upload/.gc 下（与精简包同样的相对路径 + .refs），
+精简包未变化时直接读取，只解析新增的精简包（多进程并行）
+
+引用记录格式
+0   精简包 mtime                    8 bytes (double)
+1   精简包大小                      8 bytes
+    引用的 md5                      16 bytes * n
+
+包文件存储中的块没有各自的 mtime，upload/.gc/packs.seen 记录 GC 首次看到各块的时间，
+按该时间判断 grace（首次看到后超过 grace 才会被清除）
+0   md5                             16 bytes
+1   首次看到的时间                  8 bytes (double)
+'''
+
+gc_folder = '.gc'
+refs_ext = '.refs'
+refs_header = struct.Struct('<dQ')
+seen_name = 'packs.seen'
+seen_record = struct.Struct('<16sd')
+
+# upload 目录下不是 <项目-分支> 的子目录
+skip_folders = ('blocks', 'deltas', gc_folder)
+
+
+def is_side_file(name):
+    ''' 精简包的附属文件（bundle、差量索引） '''
+    return name.endswith(block_bundle.index_path('')) or \
+        name.endswith(block_delta.index_path('')) or \
+        '.bundle-' in name
+
+
+def is_shrink_package(path):
+    ''' 末尾（去掉原始包 hash）能找到中央目录结束标记 '''
+    size = os.path.getsize(path)
+    # 结束标记（含最长注释）+ zip64 结束记录定位 + zip64 结束记录
+    tail_len = min(size, 0xffff + 22 + 20 + 56 + zip_utils.hash_len)
+    with open(path, 'rb') as f:
+        f.seek(size - tail_len)
+        tail = f.read()
+    return zip_utils.parse_EOCD(tail[:-zip_utils.hash_len])[0] >= 0
+
+
+def list_packages(base_folder):
+    ''' 列出所有精简包
+    Returns:
+        {目录: [精简包相对路径, ...]}
+    '''
+
+    packages = {}
+    for folder in sorted(os.listdir(base_folder)):
+        path = os.path.join(base_folder, folder)
+        if folder in skip_folders or not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            pkg_path = os.path.join(path, name)
+            if is_side_file(name) or not os.path.isfile(pkg_path) or \
+                    not is_shrink_package(pkg_path):
+                continue
+            packages.setdefault(folder, []).append(folder + '/' + name)
+    return packages
+
+
+def build_id(rel_path):
+    ''' 构建标识：<日期>-<git_hash>，同一次构建的多个包（apk、ipa、各渠道）一起保留或删除 '''
+    return os.path.basename(rel_path).split('.')[0]
+
+
+def select_retained(base_folder, packages, keep_last, max_age):
+    ''' 按保留策略划分精简包，未指定任何策略时全部保留
+    Args:
+        keep_last: 每个目录保留最近的构建数
+        max_age:   保留最近多少天内的构建
+    Returns:
+        (保留的精简包, 过期的精简包)
+    '''
+
+    retained = []
+    expired = []
+    now = time.time()
+    for folder, paths in packages.items():
+        # 构建 -> 最后修改时间
+        builds = {}
+        for path in paths:
+            mtime = os.path.getmtime(os.path.join(base_folder, path))
+            key = build_id(path)
+            builds[key] = max(builds.get(key, 0), mtime)
+        order = sorted(builds, key=lambda x: builds[x], reverse=True)
+
+        keep = set()
+        for i, key in enumerate(order):
+            if keep_last == None and max_age == None:
+                keep.add(key)
+            elif keep_last != None and i < keep_last:
+                keep.add(key)
+            elif max_age != None and now - builds[key] <= max_age * 86400:
+                keep.add(key)
+
+        for path in paths:
+            if build_id(path) in keep:
+                retained.append(path)
+            else:
+                expired.append(path)
+    return retained, expired
+
+
+def refs_path(base_folder, rel_path):
+    return os.path.join(base_folder, gc_folder, rel_path + refs_ext)
+
+
+def read_refs(base_folder, rel_path):
+    ''' 读取引用记录，精简包已变化或记录不存在时返回 None '''
+    path = refs_path(base_folder, rel_path)
+    if not os.path.exists(path):
+        return None
+    st = os.stat(os.path.join(base_folder, rel_path))
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < refs_header.size or \
+            refs_header.unpack_from(data) != (st.st_mtime, st.st_size):
+        return None
+    data = data[refs_header.size:]
+    return [data[i:i+16] for i in range(0, len(data), 16)]
+
+
+def build_refs(job):
+    ''' 解析精简包并写入引用记录（在子进程中执行）
+    Returns:
+        引用数，不是精简包时返回 None
+    '''
+
+    base_folder, rel_path = job
+    pkg_path = os.path.join(base_folder, rel_path)
+    st = os.stat(pkg_path)
+    with open(pkg_path, 'rb') as f:
+        buffer = f.read()
+
+    try:
+        digests = set(bytes.fromhex(hash) for data, hash, f in
+                      zip_repack.iter_segments(buffer[:-zip_utils.hash_len])
+                      if hash != None)
+    except Exception:
+        return None
+
+    path = refs_path(base_folder, rel_path)
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    block_store.replace_file(path, refs_header.pack(st.st_mtime, st.st_size) +
+                             b''.join(sorted(digests)))
+    return len(digests)
+
+
+def package_files(base_folder, rel_path):
+    ''' 精简包及其附属文件 '''
+    pkg_path = os.path.join(base_folder, rel_path)
+    files = [pkg_path, refs_path(base_folder, rel_path),
+             block_bundle.index_path(pkg_path),
+             block_delta.index_path(pkg_path),
+             pkg_manifest.manifest_path(pkg_path),
+             pkg_manifest.manifest_path(pkg_path)[:-len('.manifest')] +
+             '.meta']
+    folder, name = os.path.split(pkg_path)
+    prefix = name + '.bundle-'
+    files += [os.path.join(folder, x) for x in os.listdir(folder)
+              if x.startswith(prefix)]
+    return [x for x in files if os.path.exists(x)]
+
+
+def build_files(base_folder, folder, key):
+    ''' 构建的提交信息文件（构建的所有精简包都过期后删除） '''
+    files = [os.path.join(base_folder, folder, 'commits', key + '.commit'),
+             os.path.join(base_folder, 'last-%s-%s.commit' % (folder, key))]
+    return [x for x in files if os.path.exists(x)]
+
+
+def pack_first_seen(base_folder, store):
+    ''' 包文件存储中各块首次被 GC 看到的时间，新出现的块记为当前时间
+    Returns:
+        {hash: 首次看到的时间}
+    '''
+
+    path = os.path.join(base_folder, gc_folder, seen_name)
+    seen = {}
+    if os.path.exists(path):
+        for digest, t in block_store.read_records(path, seen_record):
+            seen[digest.hex()] = t
+
+    # 只保留仍在存储中的块
+    now = time.time()
+    seen = {hash: seen.get(hash, now) for hash in store.blocks}
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    block_store.replace_file(path, b''.join(
+        seen_record.pack(bytes.fromhex(hash), t)
+        for hash, t in sorted(seen.items())))
+    return seen
+
+
+def is_old(path, grace):
+    ''' 文件是否早于 grace 小时（新写入的块可能属于正在上传的包） '''
+    try:
+        return time.time() - os.path.getmtime(path) > grace * 3600
+    except FileNotFoundError:
+        return False
+
+
+def collect(base_folder, keep_last=None, max_age=None, processes=None,
+            grace=24):
+    ''' 标记，返回清除计划 '''
+
+    packages = list_packages(base_folder)
+    retained, expired = select_retained(base_folder, packages, keep_last,
+                                        max_age)
+
+    # 解析引用记录缺失或已过时的精简包
+    refs = {}
+    jobs = []
+    for rel_path in retained:
+        digests = read_refs(base_folder, rel_path)
+        if digests == None:
+            jobs.append((base_folder, rel_path))
+        else:
+            refs[rel_path] = digests
+    if jobs:
+        with ProcessPoolExecutor(processes) as pool:
+            for job, count in zip(jobs, pool.map(build_refs, jobs)):
+                if count == None:
+                    print('skip (not shrink package) => ' + job[1])
+                    continue
+                refs[job[1]] = read_refs(base_folder, job[1])
+    print('%d packages retained (%d parsed), %d expired' %
+          (len(refs), len(jobs), len(expired)))
+
+    # 标记
+    store = block_store.get_store(os.path.join(base_folder, 'blocks'))
+    marked = set()
+    recipes = set()
+    for digests in refs.values():
+        for digest in digests:
+            marked.add(digest.hex())
+    for hash in list(marked):
+        if hash in store:
+            continue
+        chunks = block_store.read_recipe(store, hash)
+        if chunks != None:
+            recipes.add(hash)
+            marked.update(h for h, size in chunks)
+
+    deltas = set()
+    for rel_path in refs:
+        path = block_delta.index_path(os.path.join(base_folder, rel_path))
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                index = json.load(f)
+            for hash, (base_hash, size) in index['deltas'].items():
+                deltas.add(block_delta.delta_name(base_hash, hash))
+
+    # 清除计划
+    if isinstance(store, block_store.BlockStore):
+        blocks = [hash for hash in store.blocks if hash not in marked and
+                  is_old(store.path(hash), grace)]
+    else:
+        seen = pack_first_seen(base_folder, store)
+        now = time.time()
+        blocks = [hash for hash in store.blocks if hash not in marked and
+                  now - seen[hash] > grace * 3600]
+    recipe_files = []
+    temp_files = []
+    for name in os.listdir(store.folder):
+        if name.endswith(block_store.recipe_ext) and \
+                name[:-len(block_store.recipe_ext)] not in recipes:
+            path = os.path.join(store.folder, name)
+            if is_old(path, grace):
+                recipe_files.append(path)
+        elif name.endswith('.tmp'):
+            # 写入中途退出的进程留下的临时文件
+            path = os.path.join(store.folder, name)
+            if is_old(path, grace):
+                temp_files.append(path)
+    delta_files = []
+    deltas_folder = os.path.join(base_folder, 'deltas')
+    if os.path.isdir(deltas_folder):
+        for name in os.listdir(deltas_folder):
+            path = os.path.join(deltas_folder, name)
+            if name not in deltas and is_old(path, grace):
+                delta_files.append(path)
+    expired_files = []
+    for rel_path in expired:
+        expired_files += package_files(base_folder, rel_path)
+    # 构建的所有精简包都过期时，同时删除提交信息（index.html 据此列出构建）
+    retained_builds = set((x.split('/')[0], build_id(x)) for x in retained)
+    for folder, key in sorted(set((x.split('/')[0], build_id(x))
+                                  for x in expired)):
+        if (folder, key) not in retained_builds:
+            expired_files += build_files(base_folder, folder, key)
+
+    return {
+        'store': store,
+        'blocks': blocks,
+        'recipes': recipe_files,
+        'temp': temp_files,
+        'deltas': delta_files,
+        'expired': expired_files,
+    }
+
+
+def report(plan):
+    store = plan['store']
+    items = [
+        ('blocks', len(plan['blocks']),
+         sum(store.size(hash) for hash in plan['blocks'])),
+    ]
+    for key in ('recipes', 'temp', 'deltas', 'expired'):
+        items.append((key, len(plan[key]),
+                      sum(os.path.getsize(x) for x in plan[key])))
+    for key, count, size in items:
+        print('%-8s %8d files %14d bytes' % (key, count, size))
+    print('total    %14d bytes reclaimable' % sum(x[2] for x in items))
+
+
+def sweep(plan):
+    ''' 清除 '''
+    store = plan['store']
+    for hash in plan['blocks']:
+        store.remove(hash)
+    for path in plan['recipes'] + plan['temp'] + plan['deltas'] + \
+            plan['expired']:
+        os.remove(path)
+    if isinstance(store, block_store.PackStore) and plan['blocks']:
+        print('%d bytes reclaimed from packs' % store.compact())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='block_gc.py')
+    parser.add_argument('folder', nargs='?', default='upload',
+                        help='upload folder')
+    parser.add_argument('--keep-last', type=int,
+                        help='keep last N builds of each project-branch')
+    parser.add_argument('--max-age', type=float,
+                        help='keep builds newer than N days')
+    parser.add_argument('--grace', type=float, default=24,
+                        help='never sweep files newer than N hours')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='processes for parsing packages')
+    parser.add_argument('--dry-run', help='only report reclaimable bytes',
+                        action='store_true')
+    args = parser.parse_args()
+
+    plan = collect(args.folder, args.keep_last, args.max_age,
+                   args.processes, args.grace)
+    report(plan)
+    if not args.dry_run:
+        sweep(plan)
+        print('done')
@@ -0,0 +1,731 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import struct
+import argparse
+import threading
+from contextlib import contextmanager
+import block_codec
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# 索引文件名（位于块目录下）
+index_name = '.index'
+
+# 写入块和索引时的 fsync 策略
+#   none    不调用 fsync，依赖操作系统回写（默认）
+#   file    发布前 fsync 文件内容，掉电后已发布的块内容完整
+#   full    另外 fsync 所在目录，掉电后发布（rename / link）本身也不会丢失
+fsync_policies = ['none', 'file', 'full']
+fsync = 'none'
+
+
+def is_hash_name(name):
+    ''' 判断文件名是否为 md5 hex '''
+    if len(name) != 32:
+        return False
+    try:
+        bytes.fromhex(name)
+    except ValueError:
+        return False
+    return True
+
+
+def read_records(path, record, offset=0):
+    ''' 一次读入索引文件（从 offset 开始），逐条解析定长记录 '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    # 丢弃末尾不完整的记录（写入中途被中断）
+    data = data[:len(data) - len(data) % record.size]
+    return record.iter_unpack(data)
+
+
+def append_records(path, data):
+    ''' 追加索引记录，一次 write 写入，多进程同时追加也不会交错 '''
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        if fsync != 'none':
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_path(path):
+    ''' 临时文件路径，每个写入者（进程、线程）各不相同，同时写入同一个文件也不会互相覆盖 '''
+    return '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+
+def write_temp(path, data):
+    ''' 写入临时文件（按 fsync 策略落盘），返回临时文件路径 '''
+    tmp = temp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync != 'none':
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+
+def sync_file(path):
+    if fsync != 'none':
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def sync_folder(folder):
+    ''' fsync 目录，保证其中的 rename / link 落盘（不支持的平台跳过） '''
+    if fsync != 'full' or not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(path, data):
+    ''' 先写临时文件再替换，避免中途失败留下损坏的文件 '''
+    os.replace(write_temp(path, data), path)
+    sync_folder(os.path.dirname(path))
+
+
+def publish(tmp, path):
+    ''' 将写好的临时文件原子地发布为 path（之后 tmp 不再存在）
+        用硬链接发布，path 已存在时失败：同一个 hash 的内容相同，
+        其他写入者（进程）已经发布时直接放弃本次写入，无需加锁
+        读者只会看到不存在或完整的文件，不会读到写了一半的块
+    Returns:
+        是否由本次写入发布
+    '''
+
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        os.remove(tmp)
+        return False
+    except OSError:
+        # 文件系统不支持硬链接，直接替换（内容相同，替换对正在读取的进程没有影响）
+        os.replace(tmp, path)
+        sync_folder(os.path.dirname(path))
+        return True
+    os.remove(tmp)
+    sync_folder(os.path.dirname(path))
+    return True
+
+
+class BlockStore(object):
+    ''' 块存储，每个文件内容以 <md5> 为文件名存放在目录下
+
+    目录下的 .index 为持久化索引，记录所有已知块的 hash 和大小，
+    启动时一次读入，之后的存在性判断都是内存查询，不再逐个 stat（NFS 上非常慢）
+
+    索引为追加写入的定长记录
+    0   md5                             16 bytes
+    1   size                            8 bytes  (有符号，-1 表示块已删除)
+
+    多个进程（并行的构建任务、downloader）可以共用同一个目录：
+    块先写入临时文件再发布（见 publish），同一个块只有一个写入者成功，
+    其他进程的内存索引中没有的块，写入时发现已存在即视为已写入
+    '''
+
+    record = struct.Struct('<16sq')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, index_name)
+        # hash -> size
+        self.blocks = {}
+
+        if os.path.exists(self.index_path):
+            self.load()
+        else:
+            self.rebuild()
+
+    def __contains__(self, hash):
+        return hash in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def path(self, hash):
+        return os.path.join(self.folder, hash)
+
+    def size(self, hash):
+        return self.blocks[hash]
+
+    def load(self):
+        ''' 一次读入整个索引 '''
+        for digest, size in read_records(self.index_path, self.record):
+            if size < 0:
+                self.blocks.pop(digest.hex(), None)
+            else:
+                self.blocks[digest.hex()] = size
+
+    def append_index(self, items):
+        data = b''.join(self.record.pack(bytes.fromhex(hash), size)
+                        for hash, size in items)
+        append_records(self.index_path, data)
+
+    def write_index(self):
+        ''' 重写整个索引（同时清理已删除的记录） '''
+        replace_file(self.index_path, b''.join(
+            self.record.pack(bytes.fromhex(hash), size)
+            for hash, size in sorted(self.blocks.items())))
+
+    def add(self, hash, data):
+        ''' 写入块内容，已存在则跳过
+        Returns:
+            是否为新写入的块
+        '''
+
+        if hash in self.blocks:
+            return False
+
+        path = self.path(hash)
+        if not publish(write_temp(path, data), path):
+            # 其他进程已写入（编码方式可能不同，大小以已发布的文件为准）
+            self.blocks[hash] = os.path.getsize(path)
+            return False
+
+        size = len(data)
+        self.blocks[hash] = size
+        self.append_index([(hash, size)])
+        return True
+
+    def add_file(self, hash, path):
+        ''' 将已写好的文件移入存储（需与存储目录在同一文件系统），已存在则删除该文件
+        Returns:
+            是否为新写入的块
+        '''
+
+        if hash in self.blocks:
+            os.remove(path)
+            return False
+
+        size = os.path.getsize(path)
+        sync_file(path)
+        if not publish(path, self.path(hash)):
+            self.blocks[hash] = os.path.getsize(self.path(hash))
+            return False
+        self.blocks[hash] = size
+        self.append_index([(hash, size)])
+        return True
+
+    def iter_data(self, hash, view):
+        ''' 分段读取块内容
+        Args:
+            hash: 块 hash
+            view: 复用的缓冲区，返回的数据是它的切片
+        '''
+
+        with open(self.path(hash), 'rb', buffering=0) as file:
+            while True:
+                n = file.readinto(view)
+                if not n:
+                    break
+                yield view[:n]
+
+    def remove(self, hash):
+        if hash not in self.blocks:
+            return
+        try:
+            os.remove(self.path(hash))
+        except FileNotFoundError:
+            pass
+        del self.blocks[hash]
+        self.append_index([(hash, -1)])
+
+    def scan(self):
+        ''' 扫描目录，返回实际存在的块 hash -> size '''
+        blocks = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if is_hash_name(entry.name) and entry.is_file():
+                    blocks[entry.name] = entry.stat().st_size
+        return blocks
+
+    def rebuild(self):
+        ''' 目录被外部修改后，根据目录内容重建索引 '''
+        self.blocks = self.scan()
+        self.write_index()
+
+    def verify(self, check_md5=False):
+        ''' 校验索引与目录内容是否一致，并修正索引
+        Args:
+            check_md5: 是否校验块内容 md5
+        Returns:
+            (索引中存在但文件缺失或损坏的块, 目录中存在但未被索引的块)
+        '''
+
+        blocks = self.scan()
+
+        bad = []
+        for hash, size in self.blocks.items():
+            if blocks.get(hash) != size:
+                bad.append(hash)
+            elif check_md5 and get_file_md5(self.path(hash)) != hash:
+                bad.append(hash)
+        untracked = [hash for hash in blocks if hash not in self.blocks]
+
+        for hash in bad:
+            del self.blocks[hash]
+        for hash in untracked:
+            self.blocks[hash] = blocks[hash]
+        self.write_index()
+
+        return bad, untracked
+
+
+class PackStore(object):
+    ''' 包文件存储，新块追加写入到大的包文件中，避免产生海量小文件
+
+    包文件 pack-<序号>.pack 由连续的块记录组成
+    0   md5                             16 bytes
+    1   size                            8 bytes
+        data (variable size)
+
+    目录下的 packs.index 为追加写入的定长记录
+    0   md5                             16 bytes
+    1   pack number                     4 bytes
+    2   data offset                     8 bytes
+    3   size                            8 bytes  (有符号，-1 表示块已删除)
+
+    包文件本身包含 hash 和大小，索引丢失时可以通过扫描包文件重建
+
+    追加块和压缩都持有 packs.lock 的独占锁，多个进程（并行的 unpacker、
+    downloader、GC）可以共用同一个目录，压缩期间其他进程追加的记录不会丢失
+    追加前在锁内读入其他进程追加的索引记录，同一个块不会被多个进程重复写入
+    '''
+
+    index_name = 'packs.index'
+    lock_name = 'packs.lock'
+    record = struct.Struct('<16sIQq')
+    block_header = struct.Struct('<16sQ')
+    # 单个包文件大小上限
+    pack_size = 1024 * 1024 * 1024
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, self.index_name)
+        self.lock_path = os.path.join(folder, self.lock_name)
+        # hash -> (pack, offset, size)
+        self.blocks = {}
+        # 已读入的索引长度
+        self.index_size = 0
+        # pack -> mmap
+        self.maps = {}
+        # 追加写入包文件需要串行
+        self.lock = threading.Lock()
+
+        packs = self.list_packs()
+        self.last_pack = packs[-1] if packs else -1
+
+        if os.path.exists(self.index_path):
+            self.load()
+        else:
+            self.rebuild()
+
+    @contextmanager
+    def locked(self):
+        ''' 独占整个存储（本进程的其他线程和其他进程） '''
+        with self.lock, open(self.lock_path, 'a+b') as f:
+            if fcntl != None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def reload(self):
+        ''' 其他进程压缩后包文件已被替换，重新加载索引 '''
+        packs = self.list_packs()
+        self.last_pack = packs[-1] if packs else -1
+        self.maps = {}
+        self.blocks = {}
+        self.index_size = 0
+        if os.path.exists(self.index_path):
+            self.load()
+
+    def refresh(self):
+        ''' 读入其他进程追加的索引记录（持有 locked() 时调用） '''
+        size = 0
+        if os.path.exists(self.index_path):
+            size = os.path.getsize(self.index_path)
+        # 索引变短或包文件已被删除：其他进程压缩过
+        compacted = self.last_pack >= 0 and \
+            not os.path.exists(self.pack_path(self.last_pack))
+        if size < self.index_size or compacted:
+            self.reload()
+        elif size > self.index_size:
+            self.load(self.index_size)
+
+    def __contains__(self, hash):
+        return hash in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def size(self, hash):
+        return self.blocks[hash][2]
+
+    def pack_path(self, pack):
+        return os.path.join(self.folder, 'pack-%06d.pack' % pack)
+
+    def list_packs(self):
+        packs = []
+        for name in os.listdir(self.folder):
+            if name.startswith('pack-') and name.endswith('.pack'):
+                packs.append(int(name[5:-5]))
+        packs.sort()
+        return packs
+
+    def load(self, start=0):
+        ''' 一次读入整个索引（或 start 之后追加的部分） '''
+        count = 0
+        for digest, pack, offset, size in read_records(self.index_path,
+                                                        self.record, start):
+            count += 1
+            if size < 0:
+                self.blocks.pop(digest.hex(), None)
+            else:
+                self.blocks[digest.hex()] = (pack, offset, size)
+                # 其他进程可能已新建包文件
+                self.last_pack = max(self.last_pack, pack)
+        self.index_size = start + count * self.record.size
+
+    def append_index(self, items):
+        data = b''.join(self.record.pack(bytes.fromhex(hash), *location)
+                        for hash, location in items)
+        append_records(self.index_path, data)
+
+    def write_index(self):
+        ''' 重写整个索引（同时清理已删除的记录） '''
+        data = b''.join(self.record.pack(bytes.fromhex(hash), *location)
+                        for hash, location in sorted(self.blocks.items()))
+        replace_file(self.index_path, data)
+        self.index_size = len(data)
+
+    def write_block(self, hash, data):
+        ''' 追加块到当前包文件，超过上限时新建包文件
+        Returns:
+            (pack, offset, size)
+        '''
+
+        pack = self.last_pack
+        path = self.pack_path(pack)
+        if pack < 0 or os.path.getsize(path) >= self.pack_size:
+            pack = self.last_pack = pack + 1
+            path = self.pack_path(pack)
+
+        # 调用者持有 locked()，多个进程不会同时追加
+        with open(path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell() + self.block_header.size
+            f.write(self.block_header.pack(bytes.fromhex(hash), len(data)))
+            f.write(data)
+            f.flush()
+            if fsync != 'none':
+                os.fsync(f.fileno())
+
+        return pack, offset, len(data)
+
+    def add(self, hash, data):
+        ''' 写入块内容，已存在则跳过
+        Returns:
+            是否为新写入的块
+        '''
+
+        with self.locked():
+            self.refresh()
+            if hash in self.blocks:
+                return False
+
+            location = self.write_block(hash, data)
+            self.blocks[hash] = location
+            self.append_index([(hash, location)])
+            return True
+
+    def add_file(self, hash, path):
+        ''' 将已写好的文件追加到包文件中，完成后删除该文件
+        Returns:
+            是否为新写入的块
+        '''
+
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self.add(hash, mm)
+        finally:
+            mm.close()
+            os.remove(path)
+
+    def get_map(self, pack, end):
+        ''' 获取包文件的 mmap，包文件追加过内容时重新映射 '''
+        mm = self.maps.get(pack)
+        if mm == None or len(mm) < end:
+            with open(self.pack_path(pack), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # 旧的映射可能仍被切片引用，交给 GC 回收
+            self.maps[pack] = mm
+        return mm
+
+    def get(self, hash):
+        ''' 获取块内容（包文件 mmap 的切片，不拷贝） '''
+        pack, offset, size = self.blocks[hash]
+        mm = self.get_map(pack, offset + size)
+        return memoryview(mm)[offset:offset+size]
+
+    def iter_data(self, hash, view):
+        ''' 读取块内容，直接返回 mmap 切片，view 参数仅为与 BlockStore 保持一致 '''
+        yield self.get(hash)
+
+    def remove(self, hash):
+        ''' 只在索引中标记删除，空间由 compact 回收 '''
+        with self.locked():
+            self.refresh()
+            if hash not in self.blocks:
+                return
+            del self.blocks[hash]
+            self.append_index([(hash, (0, 0, -1))])
+
+    def scan(self):
+        ''' 扫描所有包文件，返回 hash -> (pack, offset, size) '''
+        blocks = {}
+        header_len = self.block_header.size
+        for pack in self.list_packs():
+            with open(self.pack_path(pack), 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + header_len <= len(data):
+                digest, size = self.block_header.unpack_from(data, offset)
+                offset += header_len
+                # 末尾写入不完整的块
+                if offset + size > len(data):
+                    break
+                blocks.setdefault(digest.hex(), (pack, offset, size))
+                offset += size
+        return blocks
+
+    def rebuild(self):
+        ''' 索引丢失或损坏时，扫描包文件重建索引（已删除但未压缩的块会被恢复） '''
+        self.blocks = self.scan()
+        self.write_index()
+
+    def verify(self, check_md5=False):
+        ''' 校验索引与包文件内容是否一致，并修正索引
+        Args:
+            check_md5: 是否校验块内容 md5
+        Returns:
+            (索引中存在但内容缺失或损坏的块, 包文件中存在但未被索引的块)
+        '''
+
+        blocks = self.scan()
+
+        bad = []
+        for hash, location in self.blocks.items():
+            if blocks.get(hash) != location:
+                bad.append(hash)
+            elif check_md5 and block_codec.get_md5([self.get(hash)]) != hash:
+                bad.append(hash)
+        untracked = [hash for hash in blocks if hash not in self.blocks]
+
+        for hash in bad:
+            del self.blocks[hash]
+        for hash in untracked:
+            self.blocks[hash] = blocks[hash]
+        self.write_index()
+
+        return bad, untracked
+
+    def compact(self):
+        ''' 将有效块重写到新的包文件，回收已删除块占用的空间
+        Returns:
+            回收的字节数
+        '''
+
+        with self.locked():
+            # 重新加载索引，包含其他进程追加的块
+            self.reload()
+            old_packs = self.list_packs()
+            old_size = sum(os.path.getsize(self.pack_path(pack))
+                           for pack in old_packs)
+
+            # 按原有顺序依次写入新的包文件
+            old_blocks = self.blocks
+            self.blocks = {}
+            self.last_pack += 1
+            open(self.pack_path(self.last_pack), 'wb').close()
+            for hash, location in sorted(old_blocks.items(),
+                                         key=lambda x: x[1][:2]):
+                pack, offset, size = location
+                data = self.get_map(pack, offset + size)[offset:offset+size]
+                self.blocks[hash] = self.write_block(hash, data)
+            self.write_index()
+
+            # 删除旧的包文件
+            self.maps = {}
+            for pack in old_packs:
+                os.remove(self.pack_path(pack))
+
+            new_size = sum(os.path.getsize(self.pack_path(pack))
+                           for pack in self.list_packs())
+            return old_size - new_size
+
+    def export(self, dst_folder):
+        ''' 导出为每个块一个文件的目录结构（供 pkg_loader.js 等直接按 hash 访问）
+        Returns:
+            新导出的块数量
+        '''
+
+        if not os.path.exists(dst_folder):
+            os.makedirs(dst_folder)
+        dst = BlockStore(dst_folder)
+        count = 0
+        for hash in sorted(self.blocks, key=lambda x: self.blocks[x][:2]):
+            if dst.add(hash, self.get(hash)):
+                count += 1
+        return count
+
+
+def is_pack_folder(folder):
+    ''' 目录中已有包文件索引或包文件 '''
+    if not os.path.isdir(folder):
+        return False
+    for name in os.listdir(folder):
+        if name == PackStore.index_name or name.endswith('.pack'):
+            return True
+    return False
+
+
+def get_store(item_folder, pack=False):
+    ''' 获取块存储，item_folder 可以是目录路径或已打开的存储
+        os.devnull 表示不存储块内容
+    Args:
+        item_folder: 块存储目录（或已打开的存储）
+        pack:        是否使用包文件存储（目录中已有包文件索引时自动使用）
+    '''
+
+    if item_folder == None or item_folder == os.devnull:
+        return None
+    if not isinstance(item_folder, str):
+        return item_folder
+    if pack or is_pack_folder(item_folder):
+        return PackStore(item_folder)
+    return BlockStore(item_folder)
+
+
+'''
+分块存储的文件内容（见 chunker），不写入整块，而是在块目录下写入分块清单
+    <文件内容 md5>.chunks
+
+分块清单为定长记录，按顺序拼接各分块即为文件内容
+0   分块 md5                        16 bytes
+1   分块大小                        8 bytes
+
+分块本身作为普通块存储
+'''
+
+recipe_ext = '.chunks'
+recipe_record = struct.Struct('<16sQ')
+
+
+def recipe_path(store, hash):
+    return os.path.join(store.folder, hash + recipe_ext)
+
+
+def write_recipe(store, hash, chunks):
+    ''' 写入分块清单
+    Args:
+        chunks: [(分块 hash, 分块大小), ...]
+    '''
+    replace_file(recipe_path(store, hash), b''.join(
+        recipe_record.pack(bytes.fromhex(h), size) for h, size in chunks))
+
+
+def read_recipe(store, hash):
+    ''' 读取分块清单，不存在时返回 None '''
+    path = recipe_path(store, hash)
+    if not os.path.exists(path):
+        return None
+    return [(digest.hex(), size)
+            for digest, size in read_records(path, recipe_record)]
+
+
+def has_entry(store, hash):
+    ''' 文件内容是否可以从存储中恢复（整块或全部分块） '''
+    if hash in store:
+        return True
+    chunks = read_recipe(store, hash)
+    return chunks != None and all(h in store for h, size in chunks)
+
+
+def iter_entry_data(store, hash, view):
+    ''' 分段读取文件内容（解码后的原始内容），整块不存在时按分块清单拼接 '''
+    if hash in store:
+        return block_codec.iter_decode(store.iter_data(hash, view))
+    chunks = read_recipe(store, hash)
+    if chunks == None:
+        raise KeyError(hash)
+    return (data for h, size in chunks
+            for data in block_codec.iter_decode(store.iter_data(h, view)))
+
+
+def iter_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            yield data
+
+
+# 获取块文件原始内容的 MD5（编码后的块先解码，见 block_codec）
+def get_file_md5(path):
+    return block_codec.get_md5(iter_file(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='block_store.py')
+    parser.add_argument('folder', help='blocks folder')
+    parser.add_argument('command',
+                        choices=['rebuild', 'verify', 'compact', 'export'],
+                        help='rebuild index, verify index and blocks, '
+                        'compact packs or export packs to loose files')
+    parser.add_argument('dst', nargs='?', help='export destination folder')
+    parser.add_argument('--md5', help='verify blocks md5',
+                        action='store_true')
+    parser.add_argument('--pack', help='use pack backend',
+                        action='store_true')
+    args = parser.parse_args()
+
+    store = get_store(args.folder, pack=args.pack)
+    is_pack = isinstance(store, PackStore)
+
+    if args.command == 'rebuild':
+        store.rebuild()
+        print('%d blocks indexed' % len(store))
+    elif args.command == 'verify':
+        bad, untracked = store.verify(check_md5=args.md5)
+        for hash in bad:
+            print('bad       => %s' % hash)
+        for hash in untracked:
+            print('untracked => %s' % hash)
+        print('%d blocks indexed, %d bad, %d untracked' %
+              (len(store), len(bad), len(untracked)))
+    elif not is_pack:
+        parser.error('%s needs a pack store' % args.command)
+    elif args.command == 'compact':
+        print('%d bytes reclaimed' % store.compact())
+    else:
+        if args.dst == None:
+            parser.error('export needs dst folder')
+        print('%d blocks exported' % store.export(args.dst))
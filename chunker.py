@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import block_store
+import block_codec
+import metrics
+
+'''
+大文件内容的分块（content-defined chunking）
+
+超过 threshold 的文件内容按内容切分为若干分块分别存储，
+构建之间只修改了一部分的大文件（例如 libil2cpp.so、未压缩的资源包），
+未修改区域切出的分块 hash 不变，无需重新上传和下载
+
+精简包中仍记录整个文件内容的 hash，块目录下写入分块清单（见 block_store.write_recipe）
+
+切分点参照 FastCDC 的做法
+    每个分块先跳过 min_size，切分点只出现在 [min_size, max_size] 之间
+    在 avg_size 之前使用更严格的条件，之后使用更宽松的条件，使分块大小集中在 avg_size 附近
+切分条件只取决于切分点之前的若干字节：每个字节按固定的随机表映射为 0 或 1，
+连续 n 个字节都映射为 1 的位置即为切分点。
+不逐字节计算滚动 hash，而是用 bytes.translate 和 bytes.find 完成，
+都在 C 代码中执行，比 Python 中逐字节计算快两个数量级
+'''
+
+# 超过该大小的文件内容分块存储，None 表示不分块
+threshold = None
+# 只对未压缩（stored）的文件分块，deflate 数据修改处之后的内容通常全部变化，分块收益很小
+stored_only = True
+
+# 字节映射表（由 md5 生成，不依赖随机数实现，保证各版本切分结果一致）
+table = bytes(hashlib.md5(bytes([i])).digest()[0] & 1 for i in range(256))
+
+
+class Chunker(object):
+    def __init__(self, min_size, avg_size, max_size, strict_len, loose_len):
+        '''
+        Args:
+            min_size, avg_size, max_size: 分块大小
+            strict_len, loose_len: avg_size 之前和之后的切分条件（连续映射为 1 的字节数）
+        '''
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.strict_run = b'\x01' * strict_len
+        self.loose_run = b'\x01' * loose_len
+
+    def find_cut(self, data, start):
+        ''' 查找从 start 开始的分块的结束位置 '''
+        size = len(data) - start
+        if size <= self.min_size:
+            return len(data)
+
+        lo = start + self.min_size
+        hi = start + min(size, self.max_size)
+        marks = bytes(data[lo:hi]).translate(table)
+
+        # 切分点在 avg_size 之前时使用严格条件
+        normal = min(self.avg_size, size) - self.min_size
+        i = marks.find(self.strict_run, 0, normal)
+        if i >= 0:
+            return lo + i + len(self.strict_run)
+
+        # 之后使用宽松条件（匹配可以跨过 avg_size）
+        i = marks.find(self.loose_run,
+                       max(normal - len(self.loose_run) + 1, 0))
+        if i >= 0:
+            return lo + i + len(self.loose_run)
+
+        return hi
+
+    def split(self, data):
+        ''' 切分文件内容
+        Yields:
+            (start, end): 分块在 data 中的范围
+        '''
+
+        start = 0
+        while start < len(data):
+            end = self.find_cut(data, start)
+            yield start, end
+            start = end
+
+
+# 存储使用的分块
+default = Chunker(16 * 1024, 64 * 1024, 256 * 1024, 17, 14)
+
+
+def should_chunk(f_info):
+    ''' 文件内容是否需要分块 '''
+    if threshold == None or f_info.compressed_size <= threshold:
+        return False
+    return not stored_only or f_info.method == 0
+
+
+def add_chunks(store, hash, data):
+    ''' 分块写入存储，并写入分块清单
+    Args:
+        store: 块存储
+        hash:  整个文件内容的 hash
+        data:  文件内容
+    '''
+
+    view = memoryview(data)
+    chunks = []
+    for start, end in default.split(view):
+        chunk = view[start:end]
+        chunk_hash = hashlib.md5(chunk).hexdigest()
+        encoded = block_codec.encode(chunk)
+        if store.add(chunk_hash, encoded):
+            metrics.add('blocks_new')
+            metrics.add('blocks_new_bytes', end - start)
+            metrics.add('block_bytes_written', len(encoded))
+        chunks.append((chunk_hash, end - start))
+    block_store.write_recipe(store, hash, chunks)
+    return chunks
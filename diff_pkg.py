@@ -1,31 +1,49 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import zip_shrink
 
 
+def get_files(pkg_path):
+    ''' 拆分（不存储）并记录超过阈值的文件
+    Returns:
+        ({文件名: (内容 hash, 压缩后大小)}, 原始包 md5)
+    '''
+
+    files = {}
+
+    def monitor(f_info, hash):
+        files[f_info.name] = (hash, f_info.compressed_size)
+
+    md5 = zip_shrink.shrink(pkg_path, os.devnull, os.devnull,
+                            content_monitor=monitor)
+    return files, md5
+
+
+def compare(a_files, b_files):
+    ''' 比较两个版本的文件
+    Yields:
+        ('new' | 'diff', 文件名, 压缩后大小)，按 b 中的顺序
+    '''
+
+    for name, (hash, size) in b_files.items():
+        if name not in a_files:
+            yield 'new', name, size
+        elif hash != a_files[name][0]:
+            yield 'diff', name, size
+
+
 if __name__ == '__main__':
     pkg_a = sys.argv[1]
     pkg_b = sys.argv[2]
 
-    a_files = {}
-
-    def monitor_a(f_info, hash):
-        a_files[f_info.name] = hash
-
-    def monitor_b(f_info, hash):
-        if f_info.name not in a_files:
-            print('new  => %d\t%s' %
-                  (f_info.compressed_size, f_info.name))
-        elif hash != a_files[f_info.name]:
-            print('diff => %d\t%s' %
-                  (f_info.compressed_size, f_info.name))
+    a_files, a_md5 = get_files(pkg_a)
+    b_files, b_md5 = get_files(pkg_b)
 
-    a_md5 = zip_shrink.shrink(pkg_a, '/dev/null', '/dev/null',
-                              content_monitor=monitor_a)
-    b_md5 = zip_shrink.shrink(pkg_b, '/dev/null', '/dev/null',
-                              content_monitor=monitor_b)
+    for kind, name, size in compare(a_files, b_files):
+        print('%-4s => %d\t%s' % (kind, size, name))
 
     print('%s => %s' % (pkg_a, a_md5.hex()))
     print('%s => %s' % (pkg_b, b_md5.hex()))
@@ -2,17 +2,71 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import hashlib
 import time
+import json
+import heapq
 import zip_utils
 import zip_repack
+import block_store
+import block_delta
+import block_codec
+import block_cache
+import pkg_manifest
+import metrics
 import argparse
-from urllib.parse import urlparse
-import requests
+import asyncio
 import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import aiohttp
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# 并发数范围（块多且小，瓶颈主要在单次请求的开销上）
+min_concurrency = 2
+max_concurrency = 64
+# 初始并发数
+init_concurrency = 8
+# 失败重试次数
+max_retry = 3
+# 超过该大小的块流式写入临时文件（支持断点续传），否则直接在内存中下载
+stream_threshold = 1024 * 1024
+# 流式下载每次读取的大小
+chunk_size = 256 * 1024
+# bundle 中需要的数据超过其大小的该比例时，直接下载整个 bundle
+whole_bundle_ratio = 0.5
+# 多段 Range 请求中，间隔小于该值的段合并为一段
+range_merge_gap = 1024
+# 单次请求的最大段数
+max_ranges = 64
+# 同时进行的 bundle 请求数
+bundle_concurrency = 8
+# 同时进行的差量请求数
+delta_concurrency = 8
+# 大块（流式下载的块）最多占用的并发比例
+large_ratio = 0.5
+# 单个块的超时按实测单连接速度的该比例估算
+timeout_speed_ratio = 0.25
+# 尚无实测数据时假定的单连接速度，以及估算速度的下限
+default_speed = 128 * 1024
+min_speed = 32 * 1024
+# 超时的固定部分（建立连接等）
+timeout_base = 5
+
 
+# 日志输出（恢复的包输出到 stdout 时改为 stderr）
+log_file = sys.stdout
 
-lock = threading.Lock()
+
+def log(*args):
+    print(*args, file=log_file)
 
 
 # 下载项数据结构
@@ -22,154 +76,911 @@ class DownloadInfo(object):
         self.file_info = file_info
         self.state = 'wait'
         self.retry = 0
+        # 下载结束（成功或失败）时触发，供边下载边恢复使用
+        self.event = asyncio.Event()
 
 
-# 获取文件 MD5
-def get_file_md5(path):
-    m = hashlib.md5()
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(4096)
-            if not data:
-                break
-            m.update(data)
-    return m.hexdigest()
+# 获取块原始内容 MD5（块可能经过编码，见 block_codec）
+def get_buffer_md5(buffer):
+    return block_codec.get_md5([buffer])
 
 
-# 获取二进制内容 MD5
-def get_buffer_md5(buffer):
-    m = hashlib.md5()
-    m.update(buffer)
-    return m.hexdigest()
+def lock_part(path):
+    ''' 打开临时文件并加独占锁（不等待）
+    Returns:
+        持有锁的文件对象，其他进程正在写入时返回 None
+    '''
+    f = open(path, 'a+b')
+    if fcntl != None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+    return f
+
+
+class PartialJournal(object):
+    ''' 下载中的大块记录，下载中断（包括进程被杀掉）后可以通过 Range 请求续传
+
+    partial
+        journal.json    hash -> 块大小
+        journal.lock    读写记录时的文件锁
+        <hash>.part     已下载的部分，下载期间持有文件锁
+        <hash>.<pid>-<线程>.part
+                        其他进程正在下载同一个块时，本进程使用的临时文件（不续传）
+
+    多个 downloader 进程可以共用缓存目录：记录在锁内重新读取后合并修改，
+    只清理没有记录、也没有进程持有锁的临时文件
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, 'journal.json')
+        self.lock_path = os.path.join(folder, 'journal.lock')
+        os.makedirs(folder, exist_ok=True)
+        # hash -> (临时文件路径, 持有锁的文件对象)
+        self.parts = {}
+
+        # 清理没有记录的临时文件
+        with self.locked():
+            items = self.load()
+            for name in os.listdir(folder):
+                if not name.endswith('.part') or name[:-5] in items:
+                    continue
+                path = os.path.join(folder, name)
+                f = lock_part(path)
+                if f != None:
+                    os.remove(path)
+                    f.close()
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, 'a+b') as f:
+            if fcntl != None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, items):
+        block_store.replace_file(self.path, json.dumps(items).encode())
+
+    def part_path(self, hash):
+        return os.path.join(self.folder, hash + '.part')
+
+    def begin(self, hash, size):
+        ''' 开始下载
+        Returns:
+            (临时文件路径, 续传的起始位置)
+        '''
+
+        self.release(hash)
+        path = self.part_path(hash)
+        with self.locked():
+            f = lock_part(path)
+            if f == None:
+                # 写入缓存时去重（见 block_store.publish）
+                path = os.path.join(self.folder, '%s.%d-%d.part' % (
+                    hash, os.getpid(), threading.get_ident()))
+                f = lock_part(path)
+                f.truncate(0)
+                self.parts[hash] = (path, f)
+                return path, 0
+
+            self.parts[hash] = (path, f)
+            items = self.load()
+            if items.get(hash) == size:
+                return path, os.path.getsize(path)
+
+            items[hash] = size
+            self.save(items)
+            f.truncate(0)
+            return path, 0
+
+    def finish(self, hash):
+        ''' 下载完成或需要重新下载，清理临时文件和记录 '''
+        if hash not in self.parts:
+            return
+        path = self.parts[hash][0]
+        with self.locked():
+            if os.path.exists(path):
+                os.remove(path)
+            if path == self.part_path(hash):
+                items = self.load()
+                if items.pop(hash, None) != None:
+                    self.save(items)
+        self.release(hash)
+
+    def release(self, hash):
+        ''' 释放临时文件的锁（下载出错时保留已下载的部分，之后续传） '''
+        if hash in self.parts:
+            self.parts.pop(hash)[1].close()
+
+    def close(self):
+        for hash in list(self.parts):
+            self.release(hash)
+
+
+# 获取下载列表（未缓存的块，内容相同的文件只下载一次），已缓存的块记录访问
+def get_downloads(items, store, tracker=None):
+    downloads = []
+    hashes = set()
+
+    def add(hash, f):
+        if hash in store or hash in hashes:
+            return
+        hashes.add(hash)
+        downloads.append(DownloadInfo(hash, f))
+
+    for hash, f in items:
+        if hash == None or hash in hashes:
+            continue
+        if block_store.has_entry(store, hash):
+            if tracker != None:
+                tracker.touch_entry(hash)
+            metrics.add('blocks_cached')
+            metrics.add('blocks_cached_bytes', f.compressed_size)
+            continue
+        # 清单中带有分块列表的文件内容，直接下载缺失的分块
+        chunks = getattr(f, 'chunks', None)
+        if chunks == None:
+            add(hash, f)
+            continue
+        hashes.add(hash)
+        block_store.write_recipe(store, hash, chunks)
+        for chunk_hash, size in chunks:
+            add(chunk_hash,
+                pkg_manifest.Entry(f.name, chunk_hash, size, f.offset))
+
+    metrics.add('blocks_missing', len(downloads))
+    metrics.add('blocks_missing_bytes',
+                sum(d.file_info.compressed_size for d in downloads))
+    return downloads
 
 
 # 解析 shrink 包
-def parse_shrink_package(buffer, item_folder):
+def parse_shrink_package(buffer, store, tracker=None):
     ''' 分析精简后的 zip 包
     Args:
-        buffer:    精简后的 zip 包二进制
-        item_folder: 文件内容存储路径
+        buffer:  精简后的 zip 包二进制
+        store:   块存储
+        tracker: 缓存访问记录（见 block_cache）
     '''
 
-    downloads = []
-
     # 抽取原始压缩文件 hash
     origin_md5 = buffer[-zip_utils.hash_len:].hex()
     buffer = buffer[:-zip_utils.hash_len]
 
-    file_infos = zip_utils.get_file_infos(buffer)
+    # 按偏移顺序遍历所有文件
+    with metrics.phase('parse'):
+        downloads = get_downloads(
+            ((hash, f) for data, hash, f in zip_repack.iter_segments(buffer)),
+            store, tracker)
+    return downloads, origin_md5
 
-    # 抽出大小，用于修正精简版 zip 中文件头的偏移
-    ex_size = 0
-    # 遍历所有文件
-    for f in file_infos:
-        header_offset = f.header_offset - ex_size
-        offset = (header_offset +
-                  zip_utils.get_header_len(buffer, header_offset))
 
-        # 读取记录的内容 hash
-        hash = buffer[offset:offset+zip_utils.hash_len].hex()
+class ConcurrencyController(object):
+    ''' 根据实测吞吐量和错误率调整并发数
+        慢启动阶段吞吐量上升就翻倍，之后逐步试探（+1），
+        吞吐量下降时回退（-1），错误率过高时减半
+    '''
 
-        # 查找是否被缓存
-        path = os.path.join(item_folder, hash)
-        if not os.path.exists(path):
-            downloads.append(DownloadInfo(hash, f))
+    def __init__(self):
+        self.limit = init_concurrency
+        self.slow_start = True
+        self.last_throughput = 0
+        self.last_time = time.time()
+        # 单连接速度（指数移动平均）
+        self.speed = None
+        # 本周期内的统计
+        self.bytes = 0
+        self.success = 0
+        self.error = 0
 
-        # 偏移修正
-        ex_size += f.compressed_size - zip_utils.hash_len
+    def on_success(self, size, elapsed):
+        self.bytes += size
+        self.success += 1
+        speed = size / max(elapsed, 0.001)
+        if self.speed == None:
+            self.speed = speed
+        else:
+            self.speed = self.speed * 0.8 + speed * 0.2
 
-    return downloads, origin_md5
+    def timeout(self, size):
+        ''' 按实测单连接速度估算下载 size 字节的超时 '''
+        if self.speed == None:
+            speed = default_speed
+        else:
+            speed = max(self.speed * timeout_speed_ratio, min_speed)
+        return aiohttp.ClientTimeout(total=size / speed + timeout_base)
 
+    def on_error(self):
+        self.error += 1
 
-# 轮询下载
-def download_next(downloads, base_url, item_folder):
-    def get_next():
-        lock.acquire()
+    def adjust(self):
+        now = time.time()
+        throughput = self.bytes / max(now - self.last_time, 0.001)
+        total = self.success + self.error
 
-        next = None
-        for d in downloads:
-            if d.state == 'wait':
-                d.state = 'downloading'
-                next = d
-                break
+        if total == 0:
+            return
 
-        lock.release()
-        return next
+        if self.error / total > 0.1:
+            self.limit = max(min_concurrency, self.limit // 2)
+            self.slow_start = False
+        elif throughput > self.last_throughput * 1.05:
+            self.limit = min(max_concurrency,
+                             self.limit * 2 if self.slow_start
+                             else self.limit + 1)
+        elif throughput < self.last_throughput * 0.9:
+            self.limit = max(min_concurrency, self.limit - 1)
+            self.slow_start = False
 
-    while True:
-        next = get_next()
-        if next == None:
-            break
+        self.last_throughput = throughput
+        self.last_time = now
+        self.bytes = 0
+        self.success = 0
+        self.error = 0
 
-        hash = next.hash
-        timeout = next.file_info.compressed_size / (1024 * 128) + 5
 
-        try:
-            r = requests.get(base_url + '/blocks/' + hash, timeout=timeout)
-            if r.status_code != 200:
-                raise Exception('error: status_code: %d' % r.status_code)
-
-            h = get_buffer_md5(r.content)
-            if h != hash:
-                raise Exception('error: md5 not match')
-
-            path = os.path.join(item_folder, hash)
-            with open(path, 'wb') as f:
-                f.write(r.content)
-            print('downloaded: %s %s' % (hash, next.file_info.name))
-
-            lock.acquire()
-            next.state = 'done'
-            lock.release()
-
-        except Exception as e:
-            print(e)
-
-            lock.acquire()
-            if next.retry > 2:
-                print('retry fail' + hash)
-                next.state = 'fail'
+class Scheduler(object):
+    ''' 下载调度
+        大块（流式下载的块）按大小降序优先派发，避免最后才开始的大块拖长总时间，
+        但最多占用 large_ratio 的并发；其余块按偏移顺序派发，使边下载边恢复尽早推进
+        状态计数和字节进度增量维护，不再每秒遍历所有下载项
+    '''
+
+    def __init__(self, downloads):
+        # 大块堆 (-大小, 序号, 下载项)
+        self.large = []
+        # 小块按偏移顺序
+        self.small = deque()
+        self.running_large = 0
+        # 重试的大块排在同样大小的块之前
+        self.retry_seq = 0
+        self.counts = {'wait': 0, 'downloading': 0, 'done': 0, 'fail': 0}
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.start_time = time.time()
+
+        for i, d in enumerate(downloads):
+            size = d.file_info.compressed_size
+            self.total_bytes += size
+            self.counts[d.state] += 1
+            if size > stream_threshold:
+                self.large.append((-size, i, d))
             else:
-                print('retry ' + hash)
-                next.retry += 1
-                next.state = 'wait'
-            lock.release()
-
-
-# 下载队列监控
-def monitor(downloads):
-    while True:
-        time.sleep(1)
-        all_done = True
-        has_error = False
-        for d in downloads:
-            if d.state == 'done':
-                continue
-            if d.state == 'fail':
-                has_error = True
-                continue
-            all_done = False
-            break
-
-        status = {}
-        for d in downloads:
-            if d.state not in status:
-                status[d.state] = 0
-            status[d.state] += 1
-        print(status)
-
-        if all_done:
-            break
+                self.small.append(d)
+        heapq.heapify(self.large)
+
+    def __len__(self):
+        return len(self.large) + len(self.small)
+
+    def set_state(self, d, state):
+        self.counts[d.state] -= 1
+        self.counts[state] += 1
+        d.state = state
+
+    def pop(self, limit):
+        ''' 取出下一个要下载的块 '''
+        if self.large and (self.running_large < limit * large_ratio or
+                           not self.small):
+            d = heapq.heappop(self.large)[2]
+            self.running_large += 1
+        else:
+            d = self.small.popleft()
+        self.set_state(d, 'downloading')
+        return d
+
+    def finish(self, d, state):
+        ''' 下载结束（done / fail） '''
+        size = d.file_info.compressed_size
+        if size > stream_threshold:
+            self.running_large -= 1
+        self.set_state(d, state)
+        if state == 'done':
+            self.done_bytes += size
+
+    def retry(self, d):
+        ''' 重新排队，放在队首 '''
+        size = d.file_info.compressed_size
+        if size > stream_threshold:
+            self.running_large -= 1
+            self.retry_seq -= 1
+            heapq.heappush(self.large, (-size, self.retry_seq, d))
+        else:
+            self.small.appendleft(d)
+        self.set_state(d, 'wait')
+
+    def status(self, controller):
+        ''' 进度：块数、字节数、速度和预计剩余时间 '''
+        elapsed = max(time.time() - self.start_time, 0.001)
+        speed = self.done_bytes / elapsed
+        remain = self.total_bytes - self.done_bytes
+        eta = remain / speed if speed > 0 else None
+        status = dict(self.counts)
+        status['concurrency'] = controller.limit
+        status['progress'] = '%.1f/%.1f MB' % (self.done_bytes / 1048576,
+                                               self.total_bytes / 1048576)
+        status['speed'] = '%.1f KB/s' % (speed / 1024)
+        status['eta'] = '-' if eta == None else '%ds' % eta
+        return status
+
+
+class BlockNotFound(Exception):
+    pass
+
+
+# 校验并保存块（在线程池中执行，避免阻塞事件循环）
+def save_block(store, hash, content):
+    with metrics.phase('verify'):
+        h = get_buffer_md5(content)
+    if h != hash:
+        raise Exception('error: md5 not match')
+    with metrics.phase('block_write'):
+        store.add(hash, content)
+
+
+def get_file_md5(path):
+    with metrics.phase('verify'):
+        return block_store.get_file_md5(path)
+
+
+def add_file(store, hash, path):
+    with metrics.phase('block_write'):
+        return store.add_file(hash, path)
+
+
+# 流式下载大块到临时文件，支持断点续传
+async def download_block_stream(session, d, url, store, journal, controller):
+    hash = d.hash
+    size = d.file_info.compressed_size
+    loop = asyncio.get_running_loop()
+
+    # 块可能经过编码（见 block_codec），实际大小以服务端返回为准
+    path, offset = journal.begin(hash, size)
+    received = 0
+    timeout = controller.timeout(size - offset)
+    headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else None
+    async with session.get(url, headers=headers, timeout=timeout) as r:
+        if r.status == 404:
+            journal.finish(hash)
+            raise BlockNotFound(hash)
+        if r.status == 416 and offset > 0:
+            # 上次已下载完整，只是没有完成校验
+            pass
+        elif r.status == 200 or r.status == 206 and offset > 0:
+            if r.status == 200:
+                # 服务器不支持 Range，从头下载
+                offset = 0
+            with open(path, 'ab' if offset > 0 else 'wb') as f:
+                async for data in r.content.iter_chunked(chunk_size):
+                    received += len(data)
+                    f.write(data)
+            metrics.add('bytes_downloaded', received)
+        else:
+            # 续传失败，下次从头下载
+            journal.finish(hash)
+            raise Exception('error: status_code: %d' % r.status)
+
+    # 校验解码后的内容
+    md5 = await loop.run_in_executor(None, get_file_md5, path)
+    if md5 != hash:
+        journal.finish(hash)
+        raise Exception('error: md5 not match')
+
+    await loop.run_in_executor(None, add_file, store, hash, path)
+    journal.finish(hash)
+    log('downloaded: %s %s' % (hash, d.file_info.name))
+    return received
+
+
+# 下载并保存小块，返回下载的字节数
+async def fetch_block(session, url, hash, size, store, controller):
+    timeout = controller.timeout(size)
+    async with session.get(url, timeout=timeout) as r:
+        if r.status == 404:
+            raise BlockNotFound(hash)
+        if r.status != 200:
+            raise Exception('error: status_code: %d' % r.status)
+        content = await r.read()
+    metrics.add('bytes_downloaded', len(content))
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, save_block, store, hash, content)
+    return len(content)
+
+
+# 整块不存在时（服务端分块存储，见 chunker），按分块清单依次下载缺失的分块
+async def download_chunked(session, d, base_url, store, controller):
+    url = base_url + '/blocks/' + d.hash + block_store.recipe_ext
+    async with session.get(url) as r:
+        if r.status != 200:
+            raise Exception('error: status_code: %d' % r.status)
+        data = await r.read()
+
+    record = block_store.recipe_record
+    if len(data) % record.size != 0:
+        raise Exception('error: bad chunk list ' + d.hash)
+    chunks = [(digest.hex(), size) for digest, size in record.iter_unpack(data)]
+    if sum(size for h, size in chunks) != d.file_info.compressed_size:
+        raise Exception('error: chunk list size not match ' + d.hash)
+
+    total = 0
+    for hash, size in chunks:
+        if hash not in store:
+            total += await fetch_block(session, base_url + '/blocks/' + hash,
+                                       hash, size, store, controller)
+    block_store.write_recipe(store, d.hash, chunks)
+    log('downloaded: %s %s (%d chunks)' %
+        (d.hash, d.file_info.name, len(chunks)))
+    return total
+
+
+# 下载单个块
+async def download_block(session, d, base_url, store, journal, controller):
+    hash = d.hash
+    size = d.file_info.compressed_size
+    url = base_url + '/blocks/' + hash
+    try:
+        if size > stream_threshold:
+            return await download_block_stream(session, d, url, store,
+                                               journal, controller)
+        size = await fetch_block(session, url, hash, size, store, controller)
+    except BlockNotFound:
+        return await download_chunked(session, d, base_url, store, controller)
+
+    log('downloaded: %s %s' % (hash, d.file_info.name))
+    return size
+
+
+# 并发下载所有块，返回是否有下载失败的块
+async def download_blocks(session, downloads, base_url, store, controller):
+    journal = PartialJournal(os.path.join(store.folder, 'partial'))
+    scheduler = Scheduler(downloads)
+    # task -> (下载项, 开始时间)
+    running = {}
+    has_error = False
+    last_report = time.time()
+
+    try:
+        while scheduler or running:
+            # 按当前并发上限派发任务
+            while scheduler and len(running) < controller.limit:
+                d = scheduler.pop(controller.limit)
+                task = asyncio.ensure_future(download_block(
+                    session, d, base_url, store, journal, controller))
+                running[task] = (d, time.time())
+
+            done, _ = await asyncio.wait(running.keys(), timeout=1,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                d, start = running.pop(task)
+                e = task.exception()
+                elapsed = time.time() - start
+                if e == None:
+                    scheduler.finish(d, 'done')
+                    d.event.set()
+                    controller.on_success(task.result(), elapsed)
+                    metrics.observe('block_latency_ms', elapsed * 1000)
+                    continue
+
+                log(e if str(e) else repr(e))
+                controller.on_error()
+                metrics.observe('block_error_latency_ms', elapsed * 1000)
+                if d.retry >= max_retry:
+                    log('retry fail ' + d.hash)
+                    scheduler.finish(d, 'fail')
+                    d.event.set()
+                    has_error = True
+                    metrics.add('failures')
+                else:
+                    log('retry ' + d.hash)
+                    d.retry += 1
+                    scheduler.retry(d)
+                    metrics.add('retries')
+
+            # 每秒调整并发数并输出状态
+            if time.time() - last_report >= 1:
+                last_report = time.time()
+                controller.adjust()
+                log(scheduler.status(controller))
+    finally:
+        journal.close()
+
+    return has_error
+
+
+# 解析 Content-Range 的起始位置
+def parse_content_range(value):
+    # bytes 100-199/1000
+    return int(value.split()[1].split('-')[0])
+
+
+# 规划 bundle 请求，返回 [(bundle 名, Range 段列表（None 为整个下载）, 块列表)]
+def plan_bundle_requests(index, downloads):
+    groups = {}
+    for d in downloads:
+        bundle, offset, size = index['blocks'][d.hash]
+        groups.setdefault(bundle, []).append((offset, size, d))
+
+    requests = []
+    for bundle, items in sorted(groups.items()):
+        name, bundle_size = index['bundles'][bundle]
+        items.sort(key=lambda x: x[0])
+
+        needed = sum(x[1] for x in items)
+        if needed >= bundle_size * whole_bundle_ratio:
+            requests.append((name, None, items))
+            continue
+
+        # 合并相邻的段，每个请求最多 max_ranges 段
+        ranges = []
+        request_items = []
+        for offset, size, d in items:
+            if ranges and offset - ranges[-1][1] <= range_merge_gap:
+                ranges[-1][1] = offset + size
+            else:
+                if len(ranges) == max_ranges:
+                    requests.append((name, ranges, request_items))
+                    ranges = []
+                    request_items = []
+                ranges.append([offset, offset + size])
+            request_items.append((offset, size, d))
+        requests.append((name, ranges, request_items))
+
+    return requests
+
+
+# 从收到的数据段中取出块，校验并保存，返回失败的块
+def save_bundle_blocks(store, items, pieces):
+    failed = []
+    for offset, size, d in items:
+        data = None
+        for start, piece in pieces:
+            if start <= offset and offset + size <= start + len(piece):
+                data = piece[offset-start:offset-start+size]
+                break
+
+        with metrics.phase('verify'):
+            ok = data != None and get_buffer_md5(data) == d.hash
+        if not ok:
+            failed.append(d)
+            continue
+
+        with metrics.phase('block_write'):
+            store.add(d.hash, data)
+        d.state = 'done'
+        d.event.set()
+    return failed
+
+
+# 下载 bundle 整体或其中的多个段，返回失败的块
+async def download_bundle_request(session, url, ranges, items, store,
+                                  controller):
+    headers = None
+    size = sum(x[1] for x in items)
+    if ranges != None:
+        headers = {'Range': 'bytes=' + ','.join(
+            '%d-%d' % (start, end - 1) for start, end in ranges)}
+    timeout = controller.timeout(size)
+
+    # [(起始位置, 数据)]
+    pieces = []
+    start_time = time.time()
+    async with session.get(url, headers=headers, timeout=timeout) as r:
+        if r.status == 200:
+            pieces.append((0, await r.read()))
+        elif r.status != 206:
+            raise Exception('error: status_code: %d' % r.status)
+        elif r.headers.get('Content-Type', '').startswith(
+                'multipart/byteranges'):
+            reader = aiohttp.MultipartReader.from_response(r)
+            while True:
+                part = await reader.next()
+                if part == None:
+                    break
+                start = parse_content_range(part.headers['Content-Range'])
+                pieces.append((start, await part.read(decode=False)))
+        else:
+            start = parse_content_range(r.headers['Content-Range'])
+            pieces.append((start, await r.read()))
+    metrics.observe('bundle_latency_ms', (time.time() - start_time) * 1000)
+    metrics.add('bytes_downloaded', sum(len(x[1]) for x in pieces))
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, save_bundle_blocks,
+                                      store, items, pieces)
+
+
+# 通过 bundle 下载小块，返回失败的块（之后按单个块重新下载）
+async def download_bundles(session, index, downloads, url, store,
+                           controller):
+    base_url = url[:url.rfind('/') + 1]
+    semaphore = asyncio.Semaphore(bundle_concurrency)
+
+    async def run(name, ranges, items):
+        async with semaphore:
+            try:
+                failed = await download_bundle_request(
+                    session, base_url + name, ranges, items, store,
+                    controller)
+            except Exception as e:
+                log(e if str(e) else repr(e))
+                failed = [x[2] for x in items]
+            log('bundle downloaded: %s %d/%d blocks' %
+                (name, len(items) - len(failed), len(items)))
+            return failed
+
+    results = await asyncio.gather(*[
+        run(name, ranges, items)
+        for name, ranges, items in plan_bundle_requests(index, downloads)])
+
+    failed = []
+    for x in results:
+        failed += x
+    return failed
+
+
+# 由基准内容和差量恢复块，校验并保存
+def save_delta_block(store, d, base_hash, delta):
+    with metrics.phase('delta_apply'):
+        base = block_delta.read_entry(store, base_hash)
+        data = block_delta.apply_delta(base, delta)
+    with metrics.phase('verify'):
+        md5 = hashlib.md5(data).hexdigest()
+    if md5 != d.hash:
+        raise Exception('error: md5 not match')
+    with metrics.phase('block_write'):
+        store.add(d.hash, block_codec.encode(data, False))
+
+
+# 基准内容已缓存的块通过差量下载，返回失败的块（之后下载完整块）
+async def download_deltas(session, index, downloads, base_url, store,
+                          controller):
+    semaphore = asyncio.Semaphore(delta_concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def run(d):
+        base_hash, size = index['deltas'][d.hash]
+        url = base_url + '/deltas/' + block_delta.delta_name(base_hash, d.hash)
+        timeout = controller.timeout(size)
+        async with semaphore:
+            try:
+                start = time.time()
+                async with session.get(url, timeout=timeout) as r:
+                    if r.status != 200:
+                        raise Exception('error: status_code: %d' % r.status)
+                    delta = await r.read()
+                metrics.observe('delta_latency_ms', (time.time() - start) * 1000)
+                metrics.add('bytes_downloaded', len(delta))
+                await loop.run_in_executor(None, save_delta_block,
+                                           store, d, base_hash, delta)
+            except Exception as e:
+                log(e if str(e) else repr(e))
+                return d
+        log('delta downloaded: %s %s (%d/%d bytes)' %
+            (d.hash, d.file_info.name, size, d.file_info.compressed_size))
+        d.state = 'done'
+        d.event.set()
+        return None
+
+    results = await asyncio.gather(*[run(d) for d in downloads])
+    return [d for d in results if d != None]
+
+
+# 获取精简包对应的 bundle 索引，没有则返回 None
+async def fetch_bundle_index(session, url):
+    async with session.get(url + '.bundles') as r:
+        if r.status != 200:
+            return None
+        return json.loads(await r.read())
+
+
+# 获取精简包对应的差量索引，没有则返回 None
+async def fetch_delta_index(session, url):
+    async with session.get(block_delta.index_path(url)) as r:
+        if r.status != 200:
+            return None
+        return json.loads(await r.read())
+
+
+# 获取精简包对应的清单，没有则返回 None
+async def fetch_manifest(session, url):
+    async with session.get(pkg_manifest.manifest_path(url)) as r:
+        if r.status != 200:
+            return None
+        data = await r.read()
+    metrics.add('bytes_downloaded', len(data))
+    with metrics.phase('parse'):
+        return pkg_manifest.Manifest.loads(data)
+
+
+# 下载精简包
+async def fetch_shrink_package(session, url):
+    async with session.get(url) as r:
+        if r.status != 200:
+            raise Exception('error: status_code: %d' % r.status)
+        content = await r.read()
+    metrics.add('bytes_downloaded', len(content))
+    return content
+
+
+# 下载所有缺失的块，返回是否有下载失败的块
+async def download_all(session, downloads, url, store):
+    index, delta_index = None, None
+    if downloads:
+        index, delta_index = await asyncio.gather(
+            fetch_bundle_index(session, url), fetch_delta_index(session, url))
+
+    # 已缓存基准内容的块通过差量下载
+    deltas = []
+    if delta_index != None:
+        deltas = [d for d in downloads if d.hash in delta_index['deltas'] and
+                  block_store.has_entry(store,
+                                        delta_index['deltas'][d.hash][0])]
+        skip = set(deltas)
+        downloads = [d for d in downloads if d not in skip]
+
+    # 有 bundle 的小块通过 bundle 下载，其余单独下载
+    bundled = []
+    loose = downloads
+    if index != None:
+        bundled = [d for d in downloads if d.hash in index['blocks']]
+        loose = [d for d in downloads if d.hash not in index['blocks']]
+
+    base_url = '/'.join(url.split('/')[:-2])
+    # 共用实测单连接速度，bundle 和差量请求也按实测速度估算超时
+    controller = ConcurrencyController()
+    has_error, failed, delta_failed = await asyncio.gather(
+        download_blocks(session, loose, base_url, store, controller),
+        download_bundles(session, index, bundled, url, store, controller),
+        download_deltas(session, delta_index, deltas, base_url, store,
+                        controller))
+    failed += delta_failed
+    if failed:
+        log('%d blocks fall back to single download' % len(failed))
+        metrics.add('fallbacks', len(failed))
+        has_error |= await download_blocks(session, failed, base_url, store,
+                                           controller)
     return has_error
 
 
+# 边下载边恢复，按偏移顺序写出，块未就绪时等待
+async def repack_pipelined(buffer, entries, downloads, store, dst,
+                           tracker=None):
+    loop = asyncio.get_running_loop()
+    pending = {d.hash: d for d in downloads}
+
+    # 输出内容 hash
+    m = hashlib.md5()
+    copy_view = memoryview(bytearray(zip_repack.copy_buffer_size))
+
+    def write_block(hash):
+        if tracker != None:
+            tracker.touch_entry(hash)
+        for data in block_store.iter_entry_data(store, hash, copy_view):
+            m.update(data)
+            dst.write(data)
+            metrics.add('bytes_written', len(data))
+
+    for data, hash, f in zip_repack.iter_segments(buffer, entries):
+        m.update(data)
+        dst.write(data)
+        metrics.add('bytes_written', len(data))
+        if hash == None:
+            continue
+
+        # 分块存储的文件内容需要等待所有分块
+        chunks = getattr(f, 'chunks', None)
+        for h in [hash] if chunks == None else [x[0] for x in chunks]:
+            d = pending.get(h)
+            if d == None:
+                continue
+            await d.event.wait()
+            if d.state != 'done':
+                raise Exception('error: block download fail: ' + h)
+
+        await loop.run_in_executor(None, write_block, hash)
+
+    dst.flush()
+    return m.digest()
+
+
+# 统计协程的耗时
+async def timed(name, coroutine):
+    with metrics.phase(name):
+        return await coroutine
+
+
+# 下载精简包及缺失的块，同时恢复原始包
+async def fetch_package(url, store, dst, tracker=None):
+    # 连接池复用 keep-alive 连接，避免每个块都重新握手
+    connector = aiohttp.TCPConnector(limit=max_concurrency,
+                                     ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        shrink = asyncio.ensure_future(fetch_shrink_package(session, url))
+
+        # 有清单时不必等精简包下载完成，直接开始下载块
+        manifest = await fetch_manifest(session, url)
+        if manifest != None:
+            entries = manifest.entries
+            with metrics.phase('parse'):
+                downloads = get_downloads(((e.hash, e) for e in entries),
+                                          store, tracker)
+        else:
+            entries = None
+            downloads, origin_md5 = parse_shrink_package(await shrink, store,
+                                                         tracker)
+        log('%d blocks need to download' % len(downloads))
+
+        download = asyncio.ensure_future(
+            timed('download', download_all(session, downloads, url, store)))
+        try:
+            content = await shrink
+            origin_md5 = content[-zip_utils.hash_len:].hex()
+            if manifest != None and manifest.md5 != origin_md5:
+                raise Exception('error: manifest not match shrink package')
+
+            buffer = content[:-zip_utils.hash_len]
+            repack = asyncio.ensure_future(
+                timed('repack', repack_pipelined(buffer, entries, downloads,
+                                                 store, dst, tracker)))
+
+            has_error = await download
+        finally:
+            download.cancel()
+
+        if has_error:
+            repack.cancel()
+            await asyncio.gather(repack, return_exceptions=True)
+            raise Exception('download fail')
+
+        repack_md5 = await repack
+
+    return origin_md5, repack_md5.hex()
+
+
+def write_metrics(target, success):
+    ''' 计算派生值并输出统计报告 '''
+    get = metrics.get
+    metrics.set_value('success', success)
+    metrics.set_value('download_mb_per_s', metrics.ratio(
+        get('bytes_downloaded') / 2 ** 20,
+        metrics.current.phases.get('download', 0)))
+    metrics.set_value('cache_hit_ratio', metrics.ratio(
+        get('blocks_cached_bytes'),
+        get('blocks_cached_bytes') + get('blocks_missing_bytes')))
+    metrics.write(target)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='PROG')
     parser.add_argument('url', help='shrink package url')
     parser.add_argument('-c', '--cache', help='cache folder')
-    parser.add_argument('-o', '--output', help='output file path or folder')
+    parser.add_argument('-o', '--output', help='output file path or folder, - for stdout')
+    parser.add_argument('--pack', help='store cache blocks in pack files',
+                        action='store_true')
+    parser.add_argument('--cache-max-size', type=int,
+                        help='evict least recently used blocks when cache '
+                        'is larger than this size (MB)')
+    parser.add_argument('--fsync', choices=block_store.fsync_policies,
+                        default='none',
+                        help='fsync policy when writing cache blocks')
+    parser.add_argument('--metrics',
+                        help='write metrics report to json file, '
+                        'or a json line to fd:<n>')
     args = parser.parse_args()
 
+    if args.metrics != None:
+        metrics.enable('downloader')
+    block_store.fsync = args.fsync
+
     # 创建缓存目录
     if args.cache == None:
         blocks_folder = 'cache'
@@ -178,54 +989,61 @@ if __name__ == '__main__':
 
     if not os.path.exists(blocks_folder):
         os.mkdir(blocks_folder)
+    # 先持有缓存目录的共享锁再加载索引，避免加载后被其他进程淘汰、压缩
+    tracker = block_cache.CacheTracker(blocks_folder, pack=args.pack)
+    store = tracker.store
 
     # 解析 url
     url = args.url
     file_name = url.split('/')[-1]
 
-    # 下载精简 zip 包
-    shrink_pkg_path = 'shrink-' + file_name
-    r = requests.get(url)
-    with open(shrink_pkg_path, 'wb') as f:
-        f.write(r.content)
-
-    # 解析精简 zip 包并获取下载列表
-    downloads, origin_md5 = parse_shrink_package(r.content, blocks_folder)
-    print('%d blocks need to download' % len(downloads))
-
-    # 开 5 个线程下载
-    base_url = '/'.join(url.split('/')[:-2])
-    for i in range(5):
-        t = threading.Thread(target=download_next, args=(
-            downloads, base_url, blocks_folder))
-        t.start()
-
-    # 开启下载监控
-    m = threading.Thread(target=monitor, args=(downloads,))
-    m.start()
-    m.join()
-
     output_path = args.output
-    if output_path == None:
-        dst_path = file_name
-    elif os.path.splitext(output_path)[1] == '':
-        dst_path = os.path.join(output_path, file_name)
+    if output_path == '-':
+        # 输出到 stdout（例如直接管道给 adb install），日志改为输出到 stderr
+        dst_path = None
+        dst = sys.stdout.buffer
+        log_file = sys.stderr
     else:
-        dst_path = output_path
+        if output_path == None:
+            dst_path = file_name
+        elif os.path.splitext(output_path)[1] == '':
+            dst_path = os.path.join(output_path, file_name)
+        else:
+            dst_path = output_path
+        dst = open(dst_path, 'wb')
 
-    print('repacking...')
+    # 下载精简 zip 包及缺失的块，同时恢复原始包（写入的同时计算 md5）
+    try:
+        origin_md5, repack_md5 = asyncio.run(
+            fetch_package(url, store, dst, tracker))
+    except Exception as e:
+        log(e)
+        repack_md5 = None
+    if dst_path != None:
+        dst.close()
 
-    # repack
-    zip_repack.repack(shrink_pkg_path, dst_path, blocks_folder)
-    # clean shrink package
-    os.remove(shrink_pkg_path)
+    # 记录访问，下载成功后按容量淘汰（当前包引用的块不会被淘汰）
+    tracker.flush()
+    if repack_md5 != None and repack_md5 == origin_md5 and \
+            args.cache_max_size != None:
+        result = tracker.evict(args.cache_max_size * 1024 * 1024)
+        if result == None:
+            log('cache in use by other process, skip eviction')
+        else:
+            log('evicted %d blocks, %d bytes' % result)
+    tracker.close()
 
     # 校验 md5
-    repack_md5 = get_file_md5(dst_path)
-    print('origin md5 => ' + origin_md5)
-    print('repack md5 => ' + repack_md5)
-    if repack_md5 != origin_md5:
-        print('md5 check fail')
+    if repack_md5 != None:
+        log('origin md5 => ' + origin_md5)
+        log('repack md5 => ' + repack_md5)
+    if args.metrics != None:
+        write_metrics(args.metrics, repack_md5 != None and
+                      repack_md5 == origin_md5)
+    if repack_md5 == None or repack_md5 != origin_md5:
+        log('md5 check fail')
+        if dst_path != None:
+            os.remove(dst_path)
         exit(1)
 
-    print('all done')
+    log('all done')
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+'''
+结构化性能统计（unpacker.py / downloader.py 的 --metrics 参数）
+
+    phases      各阶段累计耗时（秒），在线程池中执行的阶段（hash、块写入、校验）为各线程耗时之和
+    counters    字节数、块数、重试次数等计数
+    histograms  延迟分布（毫秒），按固定的桶统计，附带估算的分位数
+    values      吞吐量、去重率等派生值
+
+未开启时 current 为 None，各处的统计调用直接返回
+
+输出目标
+    <路径>      写出 JSON 文件
+    fd:<n>      向文件描述符 n 写出一行 JSON（例如 --metrics fd:3 3>>metrics.jsonl）
+'''
+
+# 延迟直方图的桶上界（毫秒），最后一个桶为超出部分
+buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+# 当前的统计
+current = None
+
+
+def bucket_names():
+    return ['<=%d' % x for x in buckets] + ['>%d' % buckets[-1]]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, report):
+        ''' 合并其他进程的直方图（report() 的输出） '''
+        names = bucket_names()
+        for name, c in report['buckets'].items():
+            self.counts[names.index(name)] += c
+        self.count += report['count']
+        self.total += report['total']
+        self.max = max(self.max, report['max'])
+
+    def percentile(self, p):
+        ''' 分位数（所在桶的上界） '''
+        n = self.count * p
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= n:
+                return buckets[i] if i < len(buckets) else self.max
+        return self.max
+
+    def report(self):
+        names = bucket_names()
+        return {
+            'count': self.count,
+            'total': round(self.total, 3),
+            'mean': round(self.total / self.count, 3) if self.count else 0,
+            'max': round(self.max, 3),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': {name: c for name, c in zip(names, self.counts) if c},
+        }
+
+
+class Metrics(object):
+    def __init__(self, tool):
+        self.tool = tool
+        self.start = time.time()
+        # 统计可能来自线程池
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.values = {}
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def merge(self, report):
+        ''' 合并其他进程的统计（批量模式的子进程） '''
+        for name, seconds in report['phases'].items():
+            self.add_phase(name, seconds)
+        for name, value in report['counters'].items():
+            self.add(name, value)
+        with self.lock:
+            for name, histogram in report['histograms'].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].merge(histogram)
+
+    def report(self):
+        return {
+            'tool': self.tool,
+            'start': self.start,
+            'elapsed': round(time.time() - self.start, 6),
+            'phases': {k: round(v, 6) for k, v in self.phases.items()},
+            'counters': dict(self.counters),
+            'histograms': {k: v.report() for k, v in self.histograms.items()},
+            'values': dict(self.values),
+        }
+
+
+def enable(tool):
+    global current
+    current = Metrics(tool)
+    return current
+
+
+@contextmanager
+def phase(name):
+    ''' 统计代码块的耗时 '''
+    if current == None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_phase(name, time.perf_counter() - start)
+
+
+def add(name, value=1):
+    if current != None:
+        current.add(name, value)
+
+
+def observe(name, value):
+    if current != None:
+        current.observe(name, value)
+
+
+def set_value(name, value):
+    if current != None:
+        current.values[name] = value
+
+
+def get(name):
+    ''' 计数的当前值 '''
+    if current == None:
+        return 0
+    return current.counters.get(name, 0)
+
+
+def ratio(a, b):
+    return round(a / b, 4) if b else None
+
+
+def write(target):
+    ''' 输出统计报告 '''
+    report = current.report()
+    if target.startswith('fd:'):
+        data = json.dumps(report, separators=(',', ':')) + '\n'
+        os.write(int(target[len('fd:'):]), data.encode())
+    else:
+        with open(target, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zip_utils
+import zip_repack
+import block_store
+
+'''
+精简包的清单文件，放在 metas 目录下，与 .meta 并列
+    metas/<精简包>.manifest
+
+客户端先下载清单即可得到需要下载的块，不必等精简包下载完成并解析中央目录
+
+格式
+    {
+        "md5": 原始包 md5,
+        "size": 原始包大小,
+        "entries": [[文件名, 内容 hash, 压缩后大小, 内容在原始包中的偏移], ...]
+    }
+entries 按偏移排序
+分块存储的文件内容（见 chunker）在末尾追加分块列表 [[分块 hash, 分块大小], ...]
+'''
+
+
+class Entry(object):
+    ''' 清单中的文件项，与 zip_utils.FileInfo 一样提供 name 和 compressed_size '''
+
+    __slots__ = ('name', 'hash', 'compressed_size', 'offset', 'chunks')
+
+    def __init__(self, name, hash, compressed_size, offset, chunks=None):
+        self.name = name
+        self.hash = hash
+        self.compressed_size = compressed_size
+        self.offset = offset
+        self.chunks = chunks
+
+    def dump(self):
+        item = [self.name, self.hash, self.compressed_size, self.offset]
+        if self.chunks != None:
+            item.append(self.chunks)
+        return item
+
+
+class Manifest(object):
+    def __init__(self, md5, size, entries):
+        self.md5 = md5
+        self.size = size
+        self.entries = entries
+
+    def dumps(self):
+        return json.dumps({
+            'md5': self.md5,
+            'size': self.size,
+            'entries': [e.dump() for e in self.entries],
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        obj = json.loads(data)
+        return Manifest(obj['md5'], obj['size'],
+                        [Entry(*x) for x in obj['entries']])
+
+
+def manifest_path(shrink_pkg_path):
+    ''' 清单路径（URL 同理） '''
+    folder, name = os.path.split(shrink_pkg_path)
+    return os.path.join(folder, 'metas', name + '.manifest')
+
+
+def build(buffer, store=None):
+    ''' 由精简包生成清单
+    Args:
+        buffer: 精简后的 zip 包二进制
+        store:  块存储，传入时记录分块存储的文件内容的分块列表
+    '''
+
+    md5 = buffer[-zip_utils.hash_len:].hex()
+    buffer = buffer[:-zip_utils.hash_len]
+
+    entries = []
+    # 在精简包中的位置
+    cursor = 0
+    # 抽出大小，精简包中位置 + 抽出大小 = 原始包中位置
+    ex_size = 0
+    for data, hash, f in zip_repack.iter_segments(buffer):
+        cursor += len(data)
+        if hash == None:
+            continue
+        chunks = None
+        if store != None and hash not in store:
+            chunks = block_store.read_recipe(store, hash)
+        entries.append(Entry(f.name, hash, f.compressed_size,
+                             cursor + ex_size, chunks))
+        cursor += zip_utils.hash_len
+        ex_size += f.compressed_size - zip_utils.hash_len
+
+    return Manifest(md5, cursor + ex_size, entries)
+
+
+def write(shrink_pkg_path, path=None, store=None):
+    ''' 为精简包生成清单文件 '''
+    with open(shrink_pkg_path, 'rb') as f:
+        buffer = f.read()
+
+    if path == None:
+        path = manifest_path(shrink_pkg_path)
+    folder = os.path.dirname(path)
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    manifest = build(buffer, store)
+    with open(path, 'w') as f:
+        f.write(manifest.dumps())
+    return manifest
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return Manifest.loads(f.read())
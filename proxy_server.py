@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import argparse
+from collections import OrderedDict
+import zip_utils
+import zip_repack
+import block_store
+import block_codec
+import aiohttp
+from aiohttp import web
+
+'''
+缓冲服务器，部署在办公室内网，上游只需要存放 unpacker.py 生成的 upload 目录
+
+    /blocks/<hash>              块（本地镜像没有时从上游获取），小块在内存中 LRU 缓存
+    /mirror/<路径>              upload 目录下的其他文件（精简包、清单、bundle 等），
+                                downloader.py 可以直接使用 /mirror/<项目-分支>/<精简包> 下载
+                                （此时块的地址为 /mirror/blocks/<hash>，与 /blocks/<hash> 相同）
+    /<项目-分支>/<精简包>       恢复后的完整包，边恢复边输出，不落盘，支持 Range 请求
+                                用于 iOS plist 安装和普通浏览器下载
+'''
+
+# 内存缓存的块大小上限
+lru_block_size = 4 * 1024 * 1024
+# 恢复完整包时提前获取的块数
+prefetch_blocks = 16
+# 读取大块时的缓冲区大小
+read_size = 1024 * 1024
+
+
+class BlockCache(object):
+    ''' 按总大小淘汰的 LRU 缓存（块编码后的内容） '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, hash):
+        data = self.items.get(hash)
+        if data != None:
+            self.items.move_to_end(hash)
+        return data
+
+    def put(self, hash, data):
+        if len(data) > lru_block_size or hash in self.items:
+            return
+        self.items[hash] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            h, old = self.items.popitem(last=False)
+            self.size -= len(old)
+
+
+class Layout(object):
+    ''' 完整包的组成：精简包中的头结构数据和各文件内容块 '''
+
+    def __init__(self, content):
+        self.md5 = content[-zip_utils.hash_len:].hex()
+        self.buffer = content[:-zip_utils.hash_len]
+        # [(数据, hash, 大小)]，数据和 hash 只有一个不为 None
+        self.segments = []
+        for data, hash, f in zip_repack.iter_segments(self.buffer):
+            if len(data) > 0:
+                self.segments.append((data, None, len(data)))
+            if hash != None:
+                self.segments.append((None, hash, f.compressed_size))
+        self.size = sum(x[2] for x in self.segments)
+
+
+def parse_range(value, size):
+    ''' 解析单段 Range，返回 (start, end)（不含 end），不支持或不合法时返回 None '''
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    start, sep, end = value[len('bytes='):].strip().partition('-')
+    try:
+        if start == '':
+            # bytes=-500 末尾 500 字节
+            n = int(end)
+            # bytes=-0 长度为 0，不可满足
+            if n <= 0:
+                return None
+            return max(size - n, 0), size
+        start = int(start)
+        end = size if end == '' else min(int(end) + 1, size)
+    except ValueError:
+        return None
+    if start >= end:
+        return None
+    return start, end
+
+
+class ProxyServer(object):
+    def __init__(self, root, upstream, cache_size):
+        self.root = root
+        self.upstream = upstream.rstrip('/') if upstream else None
+        blocks_folder = os.path.join(root, 'blocks')
+        if not os.path.exists(blocks_folder):
+            os.makedirs(blocks_folder)
+        self.store = block_store.get_store(blocks_folder)
+        self.cache = BlockCache(cache_size)
+        # 正在从上游获取的文件 path -> task，避免重复请求
+        self.fetching = {}
+        # 精简包路径 -> Layout
+        self.layouts = {}
+        self.session = None
+
+    async def start(self, app):
+        self.session = aiohttp.ClientSession()
+
+    async def stop(self, app):
+        await self.session.close()
+
+    def run_sync(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def fetch_upstream(self, path):
+        ''' 从上游获取文件内容，不存在时返回 None '''
+        if self.upstream == None:
+            return None
+        async with self.session.get(self.upstream + '/' + path) as r:
+            if r.status == 404:
+                return None
+            if r.status != 200:
+                raise web.HTTPBadGateway(
+                    text='upstream status_code: %d' % r.status)
+            return await r.read()
+
+    async def once(self, key, coro_func):
+        ''' 同一个 key 同时只执行一次 '''
+        task = self.fetching.get(key)
+        if task == None:
+            task = asyncio.ensure_future(coro_func())
+            self.fetching[key] = task
+            task.add_done_callback(lambda t: self.fetching.pop(key, None))
+        return await asyncio.shield(task)
+
+    # ---------------------------------------------------------------- blocks
+
+    async def ensure_block(self, hash):
+        ''' 保证块（或其全部分块）在本地镜像中，不存在时返回 False '''
+        if hash in self.store:
+            return True
+
+        async def fetch():
+            if hash in self.store:
+                return True
+            content = await self.fetch_upstream('blocks/' + hash)
+            if content != None:
+                md5 = await self.run_sync(block_codec.get_md5, [content])
+                if md5 != hash:
+                    raise web.HTTPBadGateway(text='md5 not match: ' + hash)
+                await self.run_sync(self.store.add, hash, content)
+                self.cache.put(hash, content)
+                return True
+
+            # 分块存储的文件内容
+            chunks = await self.run_sync(block_store.read_recipe,
+                                         self.store, hash)
+            if chunks == None:
+                data = await self.fetch_upstream(
+                    'blocks/' + hash + block_store.recipe_ext)
+                if data == None:
+                    return False
+                record = block_store.recipe_record
+                chunks = [(digest.hex(), size) for digest, size in
+                          record.iter_unpack(data)]
+            for h, size in chunks:
+                if not await self.ensure_block(h):
+                    return False
+            await self.run_sync(block_store.write_recipe, self.store, hash,
+                                chunks)
+            return True
+
+        return await self.once('blocks/' + hash, fetch)
+
+    async def read_block(self, hash):
+        ''' 读取小块编码后的内容，大块返回 None '''
+        data = self.cache.get(hash)
+        if data != None:
+            return data
+        if self.store.size(hash) > lru_block_size:
+            return None
+
+        def read():
+            view = memoryview(bytearray(self.store.size(hash)))
+            return b''.join(bytes(x) for x in self.store.iter_data(hash, view))
+
+        data = await self.run_sync(read)
+        self.cache.put(hash, data)
+        return data
+
+    async def iter_stored(self, hash):
+        ''' 分段读取块编码后的内容 '''
+        data = await self.read_block(hash)
+        if data != None:
+            yield data
+            return
+
+        # 大块在线程池中分段读取，不阻塞事件循环
+        it = self.store.iter_data(hash, memoryview(bytearray(read_size)))
+        try:
+            while True:
+                data = await self.run_sync(lambda: bytes(next(it, b'')))
+                if not data:
+                    break
+                yield data
+        finally:
+            # 提前结束时关闭文件
+            it.close()
+
+    async def iter_entry(self, hash):
+        ''' 分段读取文件内容（解码后） '''
+        if hash in self.store:
+            hashes = [hash]
+        else:
+            chunks = await self.run_sync(block_store.read_recipe,
+                                         self.store, hash)
+            hashes = [h for h, size in chunks]
+
+        for h in hashes:
+            decoder = block_codec.Decoder()
+            stored = self.iter_stored(h)
+            try:
+                async for data in stored:
+                    for out in decoder.decode(data):
+                        yield out
+            finally:
+                await stored.aclose()
+            data = decoder.finish()
+            if data:
+                yield data
+
+    async def handle_block(self, request):
+        name = request.match_info['name']
+        if name.endswith(block_store.recipe_ext):
+            return await self.handle_file(request, 'blocks/' + name)
+        if not block_store.is_hash_name(name) or \
+                not await self.ensure_block(name):
+            raise web.HTTPNotFound()
+        if name not in self.store:
+            # 只有分块，没有整块
+            raise web.HTTPNotFound()
+
+        data = await self.read_block(name)
+        if data != None:
+            return web.Response(body=data,
+                                content_type='application/octet-stream')
+
+        resp = web.StreamResponse()
+        resp.content_type = 'application/octet-stream'
+        resp.content_length = self.store.size(name)
+        await resp.prepare(request)
+        if request.method != 'HEAD':
+            stored = self.iter_stored(name)
+            try:
+                async for data in stored:
+                    await resp.write(data)
+            finally:
+                await stored.aclose()
+            await resp.write_eof()
+        return resp
+
+    # ---------------------------------------------------------------- files
+
+    async def get_file(self, path):
+        ''' 获取 upload 目录下的文件，本地镜像没有时从上游获取并保存 '''
+        local = os.path.join(self.root, path)
+        if os.path.isfile(local):
+            return local
+
+        async def fetch():
+            content = await self.fetch_upstream(path)
+            if content == None:
+                return None
+            folder = os.path.dirname(local)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            await self.run_sync(block_store.replace_file, local, content)
+            return local
+
+        return await self.once('files/' + path, fetch)
+
+    async def handle_file(self, request, path=None):
+        if path == None:
+            path = request.match_info['path']
+        path = os.path.normpath(path)
+        if path.startswith('..') or os.path.isabs(path):
+            raise web.HTTPForbidden()
+        local = await self.get_file(path)
+        if local == None:
+            raise web.HTTPNotFound()
+        return web.FileResponse(local)
+
+    # ---------------------------------------------------------------- packages
+
+    async def get_layout(self, path):
+        local = await self.get_file(path)
+        if local == None:
+            raise web.HTTPNotFound()
+        mtime = os.path.getmtime(local)
+        layout = self.layouts.get(path)
+        if layout != None and layout[0] == mtime:
+            return layout[1]
+
+        def load():
+            with open(local, 'rb') as f:
+                return Layout(f.read())
+
+        try:
+            layout = await self.run_sync(load)
+        except Exception:
+            # 不是精简包
+            raise web.HTTPNotFound()
+        self.layouts[path] = (mtime, layout)
+        return layout
+
+    async def iter_package(self, layout, start, end):
+        ''' 按偏移输出完整包 [start, end) 范围内的数据 '''
+
+        # 范围内需要的块，提前并行获取
+        needed = []
+        pos = 0
+        for data, hash, size in layout.segments:
+            if hash != None and pos + size > start and pos < end:
+                needed.append(hash)
+            pos += size
+        tasks = {}
+        semaphore = asyncio.Semaphore(prefetch_blocks)
+
+        async def prefetch(hash):
+            async with semaphore:
+                return await self.ensure_block(hash)
+
+        for hash in needed:
+            if hash not in tasks:
+                tasks[hash] = asyncio.ensure_future(prefetch(hash))
+
+        try:
+            pos = 0
+            for data, hash, size in layout.segments:
+                seg_start, seg_end = pos, pos + size
+                pos = seg_end
+                if seg_end <= start:
+                    continue
+                if seg_start >= end:
+                    break
+
+                if hash == None:
+                    yield data[max(start - seg_start, 0):end - seg_start]
+                    continue
+
+                if not await tasks[hash]:
+                    raise Exception('block not found: ' + hash)
+                cursor = seg_start
+                # Range 请求在块中间结束时提前退出，显式关闭生成器释放文件
+                entry = self.iter_entry(hash)
+                try:
+                    async for piece in entry:
+                        piece_start, cursor = cursor, cursor + len(piece)
+                        if cursor <= start:
+                            continue
+                        if piece_start >= end:
+                            break
+                        yield piece[max(start - piece_start, 0):end - piece_start]
+                finally:
+                    await entry.aclose()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    async def handle_package(self, request):
+        path = request.match_info['proj'] + '/' + request.match_info['name']
+        layout = await self.get_layout(path)
+
+        start, end = 0, layout.size
+        status = 200
+        value = request.headers.get('Range')
+        if value != None:
+            r = parse_range(value, layout.size)
+            if r == None:
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={'Content-Range': 'bytes */%d' % layout.size})
+            start, end = r
+            status = 206
+
+        resp = web.StreamResponse(status=status)
+        resp.content_type = 'application/octet-stream'
+        resp.content_length = end - start
+        resp.headers['Accept-Ranges'] = 'bytes'
+        resp.headers['ETag'] = '"%s"' % layout.md5
+        if status == 206:
+            resp.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end - 1, layout.size)
+        await resp.prepare(request)
+        if request.method == 'HEAD':
+            return resp
+
+        package = self.iter_package(layout, start, end)
+        try:
+            async for data in package:
+                await resp.write(data)
+        finally:
+            await package.aclose()
+        await resp.write_eof()
+        return resp
+
+
+def make_app(root, upstream, cache_size):
+    server = ProxyServer(root, upstream, cache_size)
+    app = web.Application()
+    app.on_startup.append(server.start)
+    app.on_cleanup.append(server.stop)
+    app.router.add_get('/blocks/{name}', server.handle_block)
+    # 通过 /mirror 下载精简包时，downloader.py 从 /mirror/blocks 获取块，同样经过缓存
+    app.router.add_get('/mirror/blocks/{name}', server.handle_block)
+    app.router.add_get('/mirror/{path:.+}', server.handle_file)
+    app.router.add_get('/{proj}/{name}', server.handle_package)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='proxy_server.py')
+    parser.add_argument('root', help='local mirror of upload folder')
+    parser.add_argument('--upstream', help='upstream url of upload folder')
+    parser.add_argument('--host', default='0.0.0.0', help='listen host')
+    parser.add_argument('--port', type=int, default=8080, help='listen port')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='memory cache size of blocks (MB)')
+    args = parser.parse_args()
+
+    web.run_app(make_app(args.root, args.upstream,
+                         args.cache_size * 1024 * 1024),
+                host=args.host, port=args.port)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import zip_utils
+import diff_pkg
+
+'''
+抽出阈值（zip_utils.threshold）调优
+
+阈值太小，小文件都成为单独的块，下载时请求数过多；
+阈值太大，精简包变大，而精简包每个构建都要完整下载
+
+按构建顺序分析一系列历史包，对每个候选阈值模拟
+    精简包大小、块数
+    相邻版本之间增量下载的字节数和请求数（上一个版本的块已缓存，精简包完整下载）
+按 增量字节数 + 请求数 * 单次请求开销 取平均开销最小的阈值
+
+推荐结果写入配置文件，unpacker.py --config 读取
+    {
+        "<项目>-<分支>": {"threshold": 8192},
+        "<项目>": {"threshold": 8192},
+        "default": {"threshold": 4096}
+    }
+查找顺序为 <项目>-<分支>、<项目>、default
+'''
+
+default_thresholds = [1024, 2048, 4096, 8192, 16384, 32768, 65536]
+# 单次请求开销（折算为字节数），大致为一个往返时间内可以传输的数据量
+default_request_cost = 16 * 1024
+
+
+def read_package(pkg_path):
+    ''' 记录包中所有文件（在子进程中执行）
+    Returns:
+        (包大小, {文件名: (内容 hash, 压缩后大小)})
+    '''
+    zip_utils.threshold = 0
+    files, md5 = diff_pkg.get_files(pkg_path)
+    return os.path.getsize(pkg_path), files
+
+
+def blocks_of(files, threshold):
+    ''' 超过阈值的文件内容 {hash: 大小} '''
+    return {hash: size for hash, size in files.values() if size > threshold}
+
+
+def simulate(packages, threshold):
+    ''' 模拟一个阈值
+    Args:
+        packages: [(包大小, 文件), ...]，按构建顺序
+    Returns:
+        各版本平均的统计
+    '''
+
+    shrink_sizes = []
+    block_counts = []
+    incremental_bytes = []
+    incremental_requests = []
+
+    prev_files = None
+    prev_blocks = None
+    for size, files in packages:
+        blocks = blocks_of(files, threshold)
+        # 精简包：内容替换为 hash（相同内容的多个文件各自记录 hash），末尾追加原始包 hash
+        shrink_size = size + zip_utils.hash_len - sum(
+            f_size - zip_utils.hash_len for hash, f_size in files.values()
+            if f_size > threshold)
+        shrink_sizes.append(shrink_size)
+        block_counts.append(len(blocks))
+
+        if prev_files != None:
+            # 新增或修改的文件中，上一个版本没有的块需要下载
+            needed = {}
+            for kind, name, f_size in diff_pkg.compare(prev_files, files):
+                hash = files[name][0]
+                if f_size > threshold and hash not in prev_blocks:
+                    needed[hash] = f_size
+            incremental_bytes.append(shrink_size + sum(needed.values()))
+            incremental_requests.append(1 + len(needed))
+
+        prev_files = files
+        prev_blocks = blocks
+
+    def mean(values):
+        return sum(values) / len(values) if values else 0
+
+    return {
+        'threshold': threshold,
+        'shrink_size': mean(shrink_sizes),
+        'blocks': mean(block_counts),
+        'incremental_bytes': mean(incremental_bytes),
+        'incremental_requests': mean(incremental_requests),
+    }
+
+
+def tune(packages, thresholds, request_cost):
+    ''' 返回 (推荐阈值, 各阈值的统计) '''
+    results = []
+    for threshold in thresholds:
+        result = simulate(packages, threshold)
+        result['cost'] = result['incremental_bytes'] + \
+            result['incremental_requests'] * request_cost
+        results.append(result)
+    best = min(results, key=lambda x: x['cost'])
+    return best['threshold'], results
+
+
+def config_keys(project, branch):
+    keys = []
+    if project != None and branch != None:
+        keys.append('%s-%s' % (project, branch))
+    if project != None:
+        keys.append(project)
+    keys.append('default')
+    return keys
+
+
+def load_threshold(config_path, project=None, branch=None):
+    ''' 从配置文件读取阈值，没有配置时返回 None '''
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    for key in config_keys(project, branch):
+        if key in config and 'threshold' in config[key]:
+            return config[key]['threshold']
+    return None
+
+
+def save_threshold(config_path, key, threshold):
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+    config.setdefault(key, {})['threshold'] = threshold
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+
+
+def print_results(best, results):
+    print('%10s %14s %10s %16s %10s %16s' % (
+        'threshold', 'shrink_size', 'blocks', 'incr_bytes', 'incr_reqs',
+        'cost'))
+    for x in results:
+        print('%10d %14d %10d %16d %10d %16d%s' % (
+            x['threshold'], x['shrink_size'], x['blocks'],
+            x['incremental_bytes'], x['incremental_requests'], x['cost'],
+            ' *' if x['threshold'] == best else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='threshold_tuner.py')
+    parser.add_argument('package', nargs='+',
+                        help='historical packages in build order')
+    parser.add_argument('--thresholds',
+                        default=','.join(str(x) for x in default_thresholds),
+                        help='candidate thresholds, comma separated')
+    parser.add_argument('--request-cost', type=int,
+                        default=default_request_cost,
+                        help='cost of one request in bytes')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='processes for parsing packages')
+    parser.add_argument('--project', help='project name')
+    parser.add_argument('--branch', help='branch name')
+    parser.add_argument('--config',
+                        help='write recommended threshold to config file')
+    parser.add_argument('--json', help='write results to json file')
+    args = parser.parse_args()
+
+    if len(args.package) < 2:
+        parser.error('need at least 2 packages')
+    thresholds = sorted(int(x) for x in args.thresholds.split(','))
+
+    with ProcessPoolExecutor(args.processes) as pool:
+        packages = list(pool.map(read_package, args.package))
+
+    best, results = tune(packages, thresholds, args.request_cost)
+    print_results(best, results)
+    print('recommended threshold => %d' % best)
+
+    if args.json != None:
+        with open(args.json, 'w') as f:
+            json.dump({'threshold': best, 'results': results}, f, indent=4)
+    if args.config != None:
+        key = config_keys(args.project, args.branch)[0]
+        save_threshold(args.config, key, best)
+        print('%s => %s' % (key, args.config))
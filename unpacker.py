@@ -3,14 +3,25 @@
 
 import os
 import shutil
-import hashlib
 import zip_utils
 import zip_shrink
 import zip_repack
+import block_store
+import block_bundle
+import block_delta
+import block_codec
+import chunker
+import pkg_manifest
+import upload_set
+import metrics
+import threshold_tuner
 import json
 from collections import OrderedDict
 import subprocess
 import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 # 获取 Shell 命令输出
@@ -34,26 +45,19 @@ def write_json(json_data, path):
                   separators=(',', ': '), sort_keys=True)
 
 
-# 获取文件 MD5
-def get_file_md5(path):
-    m = hashlib.md5()
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(4096)
-            if not data:
-                break
-            m.update(data)
-    return m.hexdigest()
-
-
 def get_commit_infos(project):
-    branch = shell_output('git rev-parse --abbrev-ref HEAD')
+    # 一次 git show 获取所有字段，以 \0 分隔
+    output = shell_output(
+        'git --no-pager show -s --format="%D%x00%H%x00%an%x00%ci%x00%ct%x00%s" HEAD')
+    refs, hash, author, date_time, timestamp, msg = output.split('\0')
+
+    # %D: HEAD -> feature/xxx, origin/feature/xxx（分离头指针时没有 ->）
+    branch = 'HEAD'
+    if refs.startswith('HEAD -> '):
+        branch = refs[len('HEAD -> '):].split(',')[0]
     branch = branch.replace('/', '_')
-    hash = shell_output('git rev-parse HEAD')[:8]
-    author = shell_output('git --no-pager show -s --format="%an" HEAD')
-    date_time = shell_output('git --no-pager show -s --format="%ci" HEAD')
-    timestamp = int(shell_output('git --no-pager show -s --format="%ct" HEAD'))
-    msg = shell_output('git --no-pager show -s --format="%s" HEAD')
+    hash = hash[:8]
+    timestamp = int(timestamp)
 
     return {
         "project": project,
@@ -71,35 +75,98 @@ def mkdirs(folder_path):
         os.makedirs(folder_path)
 
 
-def unpack_and_check(origin_pkg, shrink_pkg, blocks_folder, content_monitor):
+def write_bundles(shrink_pkg, store, small_blocks):
+    with metrics.phase('bundle'):
+        index = block_bundle.write_bundles(shrink_pkg, store, small_blocks)
+    folder = os.path.dirname(shrink_pkg)
+    upload_set.record(block_bundle.index_path(shrink_pkg),
+                      *[os.path.join(folder, name)
+                        for name, size in index['bundles']])
+    metrics.add('bundle_bytes_written',
+                sum(size for name, size in index['bundles']))
+    return index
+
+
+def write_deltas(shrink_pkg, deltas_folder, store, delta_base, delta_entries,
+                 workers):
+    with metrics.phase('delta'):
+        index = block_delta.write_deltas(shrink_pkg, deltas_folder, store,
+                                         delta_base, delta_entries, workers)
+    upload_set.record(block_delta.index_path(shrink_pkg),
+                      *[os.path.join(deltas_folder,
+                                     block_delta.delta_name(base_hash, hash))
+                        for hash, (base_hash, size) in index['deltas'].items()])
+    metrics.add('delta_bytes_written',
+                sum(size for base_hash, size in index['deltas'].values()))
+    return index
+
+
+def write_manifest(shrink_pkg_path, store):
+    upload_set.record(pkg_manifest.manifest_path(shrink_pkg_path))
+    with metrics.phase('manifest'):
+        return pkg_manifest.write(shrink_pkg_path, store=store)
+
+
+def unpack_and_check(origin_pkg, shrink_pkg, store, content_monitor,
+                     bundle=False, workers=1, delta_base=None,
+                     deltas_folder=None):
+    # 需要打包到 bundle 的小块（按偏移顺序，不重复）
+    small_blocks = {}
+    # 需要生成差量的文件 {文件名: 内容 hash}
+    delta_entries = {}
+
+    def monitor(f_info, hash):
+        if bundle and f_info.compressed_size <= block_bundle.max_block_size \
+                and not chunker.should_chunk(f_info):
+            small_blocks[hash] = True
+        if block_delta.should_delta(f_info):
+            delta_entries[f_info.name] = hash
+        if content_monitor != None:
+            content_monitor(f_info, hash)
+
     # unpack
-    src_md5 = zip_shrink.shrink(origin_pkg, shrink_pkg, blocks_folder,
-                                content_monitor=content_monitor)
+    with metrics.phase('shrink'):
+        src_md5 = zip_shrink.shrink(origin_pkg, shrink_pkg, store,
+                                    content_monitor=monitor, workers=workers)
+    upload_set.record_package(shrink_pkg)
     src_md5 = src_md5.hex()
     print(src_md5)
 
-    # repack
-    tmp = 'repack_test.zip'
-    zip_repack.repack(shrink_pkg, tmp, blocks_folder)
-    repack_md5 = get_file_md5(tmp)
-    os.remove(tmp)
+    # 增量上传时已上传的块不在本地，从原始包读取
+    check_store = upload_set.get_check_store(store, origin_pkg)
+
+    # repack（只计算 md5，不落盘）
+    with metrics.phase('verify'):
+        repack_md5 = zip_repack.repack(shrink_pkg, os.devnull, check_store)
+    repack_md5 = repack_md5.hex()
     print(repack_md5)
 
     if src_md5 != repack_md5:
         print('repack md5 not match source package')
         exit(1)
 
+    if bundle:
+        index = write_bundles(shrink_pkg, check_store, small_blocks)
+        print('%d blocks in %d bundles' %
+              (len(index['blocks']), len(index['bundles'])))
+
+    if delta_base != None:
+        index = write_deltas(shrink_pkg, deltas_folder, check_store,
+                             delta_base, delta_entries, workers)
+        print('%d deltas' % len(index['deltas']))
+
+    if check_store != store:
+        check_store.close()
 
-def unpack_by_git(pkg_path, base_folder, blocks_folder, args):
-    # 项目
-    project = args.project
 
+def get_commit(args):
     # 获取 git 提交信息
     if args.commit_info == None:
-        commit = get_commit_infos(project)
-    else:
-        commit = read_json(args.commit_info)
+        return get_commit_infos(args.project)
+    return read_json(args.commit_info)
+
 
+def get_git_paths(pkg_path, base_folder, commit, project, tag):
     '''
     目录结构
     upload
@@ -132,7 +199,7 @@ def unpack_by_git(pkg_path, base_folder, blocks_folder, args):
     date = commit['datetime'][:10]
     date_hash = '%s-%s' % (date, commit['short_id'])
     commit_path = os.path.join(commits_folder, date_hash + '.commit')
-    tag = '' if args.tag == None else ('.' + args.tag)
+    tag = '' if tag == None else ('.' + tag)
     shrink_pkg_name = date_hash + tag + os.path.splitext(pkg_path)[1]
     shrink_pkg_path = os.path.join(
         index_folder, shrink_pkg_name)
@@ -147,22 +214,57 @@ def unpack_by_git(pkg_path, base_folder, blocks_folder, args):
         "icon": ""
     }
 
-    def monitor(f_info, hash):
-        if f_info.name == 'res/mipmap-xxhdpi-v4/app_icon.png':
-            meta['icon'] = os.path.relpath(
-                os.path.join(blocks_folder, hash), base_folder)
+    return {
+        'commit_path': commit_path,
+        'shrink_pkg_path': shrink_pkg_path,
+        'last_commit_path': last_commit_path,
+        'meta_path': meta_path,
+        'meta': meta,
+    }
+
+
+# 图标路径
+icon_name = 'res/mipmap-xxhdpi-v4/app_icon.png'
 
-    unpack_and_check(pkg_path, shrink_pkg_path, blocks_folder, monitor)
 
+def is_icon(f_info):
+    return f_info.name == icon_name
+
+
+def write_git_infos(commit, paths, args):
     if args.save_commit_info:
-        write_json(commit, commit_path)
+        write_json(commit, paths['commit_path'])
+        upload_set.record(paths['commit_path'])
     if args.last:
-        write_json(commit, last_commit_path)
+        write_json(commit, paths['last_commit_path'])
+        upload_set.record(paths['last_commit_path'])
     if not args.no_meta:
-        write_json(meta, meta_path)
+        write_json(paths['meta'], paths['meta_path'])
+        upload_set.record(paths['meta_path'])
+
+
+def unpack_by_git(pkg_path, base_folder, store, args):
+    commit = get_commit(args)
+    paths = get_git_paths(pkg_path, base_folder, commit, args.project,
+                          args.tag)
+    shrink_pkg_path = paths['shrink_pkg_path']
+    meta = paths['meta']
 
+    def monitor(f_info, hash):
+        if is_icon(f_info):
+            meta['icon'] = 'blocks/' + hash
+
+    unpack_and_check(pkg_path, shrink_pkg_path, store, monitor,
+                     bundle=args.bundle, workers=args.jobs,
+                     delta_base=args.delta_base,
+                     deltas_folder=os.path.join(base_folder, 'deltas'))
+    write_manifest(shrink_pkg_path, store)
+
+    write_git_infos(commit, paths, args)
 
-def unpack_blocks_only(pkg_path, base_folder, blocks_folder, shrink_pkg_name):
+
+def unpack_blocks_only(pkg_path, base_folder, store, shrink_pkg_name,
+                       bundle, workers, delta_base=None):
     if shrink_pkg_name != None:
         shrink_pkg_folder = os.path.join(base_folder, 'pkgs')
         mkdirs(shrink_pkg_folder)
@@ -170,19 +272,260 @@ def unpack_blocks_only(pkg_path, base_folder, blocks_folder, shrink_pkg_name):
     else:
         shrink_pkg_path = 'shrink_tmp.zip'
 
-    unpack_and_check(pkg_path, shrink_pkg_path, blocks_folder, None)
+    if shrink_pkg_name == None:
+        bundle = False
+        delta_base = None
+    unpack_and_check(pkg_path, shrink_pkg_path, store, None,
+                     bundle=bundle, workers=workers, delta_base=delta_base,
+                     deltas_folder=os.path.join(base_folder, 'deltas'))
 
     if shrink_pkg_name == None:
         os.remove(shrink_pkg_path)
+    else:
+        write_manifest(shrink_pkg_path, store)
+
+
+class ClaimStore(object):
+    ''' 批量模式下多个进程共享块目录，写入前先认领 hash，同一个块只由一个进程写入 '''
+
+    def __init__(self, store, claims):
+        self.store = store
+        self.claims = claims
+        self.pid = os.getpid()
+        self.folder = store.folder
+        # 本进程写入的块数（shrink 会在多个线程中写入）
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, hash):
+        return hash in self.store
+
+    def add(self, hash, data):
+        if self.claims.setdefault(hash, self.pid) != self.pid:
+            return False
+        if not self.store.add(hash, data):
+            return False
+        with self.lock:
+            self.added += 1
+        return True
+
+
+def batch_shrink(job):
+    ''' 批量模式，在子进程中拆分单个包 '''
+    zip_utils.threshold = job['threshold']
+    chunker.threshold = job['chunk_threshold']
+    chunker.stored_only = job['chunk_stored_only']
+    block_codec.codec = job['codec']
+    zip_shrink.raw_names.add(icon_name)
+    block_store.fsync = job['fsync']
+    if job['metrics']:
+        metrics.enable('unpacker')
+    store = block_store.get_store(job['blocks_folder'], pack=job['pack'])
+    store = ClaimStore(store, job['claims'])
+
+    result = {'icon': None, 'small_blocks': []}
+    small_blocks = {}
+    delta_entries = {}
+
+    def monitor(f_info, hash):
+        if is_icon(f_info):
+            result['icon'] = hash
+        if job['bundle'] and \
+                f_info.compressed_size <= block_bundle.max_block_size and \
+                not chunker.should_chunk(f_info):
+            small_blocks[hash] = True
+        if block_delta.should_delta(f_info):
+            delta_entries[f_info.name] = hash
+
+    with metrics.phase('shrink'):
+        src_md5 = zip_shrink.shrink(job['package'], job['shrink_pkg_path'],
+                                    store, content_monitor=monitor,
+                                    workers=job['workers'])
+    result['md5'] = src_md5.hex()
+    result['added'] = store.added
+    result['small_blocks'] = list(small_blocks)
+    result['delta_entries'] = delta_entries
+    result['metrics'] = worker_metrics()
+    return result
+
+
+def worker_metrics():
+    ''' 子进程的统计报告（进程会被复用，取出后重新开始统计） '''
+    if metrics.current == None:
+        return None
+    report = metrics.current.report()
+    metrics.current = None
+    return report
+
+
+def batch_check(job):
+    ''' 批量模式，所有包拆分完成后在子进程中校验，并生成 bundle 和清单
+    Returns:
+        (是否校验通过, 统计报告)
+    '''
+    zip_utils.threshold = job['threshold']
+    chunker.threshold = job['chunk_threshold']
+    chunker.stored_only = job['chunk_stored_only']
+    if job['metrics']:
+        metrics.enable('unpacker')
+    # 重新加载索引，包含其他进程写入的块
+    store = block_store.get_store(job['blocks_folder'], pack=job['pack'])
+    shrink_pkg_path = job['shrink_pkg_path']
+
+    with metrics.phase('verify'):
+        repack_md5 = zip_repack.repack(shrink_pkg_path, os.devnull,
+                                       store).hex()
+    if repack_md5 != job['md5']:
+        return False, worker_metrics()
+
+    if job['bundle']:
+        write_bundles(shrink_pkg_path, store, job['small_blocks'])
+    if job['delta_base'] != None:
+        write_deltas(shrink_pkg_path, job['deltas_folder'], store,
+                     job['delta_base'], job['delta_entries'], job['workers'])
+    write_manifest(shrink_pkg_path, store)
+    return True, worker_metrics()
+
+
+def merge_metrics(report):
+    if report != None:
+        metrics.current.merge(report)
+
+
+def unpack_batch(items, base_folder, blocks_folder, args):
+    ''' 批量拆分多个包（例如同一次构建的 apk、aab、ipa 及各个渠道）
+        提交信息只获取一次，多进程并行拆分到同一个 upload 目录，
+        块写入前先在进程间去重，最后统一写出 .meta、.commit、last-* 文件
+    Args:
+        items: [{"package": 包路径, "tag": 附加标签（可选）}, ...]
+    '''
+
+    commit = get_commit(args)
+
+    jobs = []
+    names = set()
+    for item in items:
+        paths = get_git_paths(item['package'], base_folder, commit,
+                              args.project, item.get('tag'))
+        if paths['shrink_pkg_path'] in names:
+            print('duplicate package name: ' + paths['shrink_pkg_path'])
+            exit(1)
+        names.add(paths['shrink_pkg_path'])
+        jobs.append(paths)
+
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(args.processes) as pool:
+        claims = manager.dict()
+        tasks = [{
+            'package': item['package'],
+            'shrink_pkg_path': paths['shrink_pkg_path'],
+            'blocks_folder': blocks_folder,
+            'pack': args.pack,
+            'bundle': args.bundle,
+            'workers': args.jobs,
+            'threshold': zip_utils.threshold,
+            'chunk_threshold': chunker.threshold,
+            'chunk_stored_only': chunker.stored_only,
+            'codec': block_codec.codec,
+            'fsync': block_store.fsync,
+            'delta_base': item.get('delta_base'),
+            'deltas_folder': os.path.join(base_folder, 'deltas'),
+            'claims': claims,
+            'metrics': metrics.current != None,
+        } for item, paths in zip(items, jobs)]
+
+        # 拆分
+        results = list(pool.map(batch_shrink, tasks))
+        for task, result in zip(tasks, results):
+            merge_metrics(result.pop('metrics'))
+            task.update(result)
+            del task['claims']
+            print('%s => %s (%d new blocks)' %
+                  (task['package'], task['md5'], task['added']))
+
+        # 全部拆分完成后再校验，避免读到其他进程未写完的块
+        checks = list(pool.map(batch_check, tasks))
+
+    for ok, report in checks:
+        merge_metrics(report)
+    for task, (ok, report) in zip(tasks, checks):
+        if not ok:
+            print('repack md5 not match source package: ' + task['package'])
+            exit(1)
+
+    # 统一写出提交信息和 meta
+    for task, paths in zip(tasks, jobs):
+        if task['icon'] != None:
+            paths['meta']['icon'] = 'blocks/' + task['icon']
+        write_git_infos(commit, paths, args)
+
+
+def write_metrics(target):
+    ''' 计算派生值并输出统计报告 '''
+    get = metrics.get
+    metrics.add('bytes_written', get('shrink_bytes_written') +
+                get('block_bytes_written') + get('bundle_bytes_written') +
+                get('delta_bytes_written'))
+    # 已存在的内容（之前的构建、本包或其他包中的相同文件和分块）节省的字节数
+    metrics.add('blocks_dedup_bytes',
+                get('entries_bytes') - get('blocks_new_bytes'))
+    metrics.set_value('dedup_ratio', metrics.ratio(
+        get('blocks_dedup_bytes'), get('entries_bytes')))
+    metrics.set_value('shrink_mb_per_s', metrics.ratio(
+        get('bytes_read') / 2 ** 20, metrics.current.phases.get('shrink', 0)))
+    metrics.write(target)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='unpacker.py')
-    parser.add_argument('package', help='package file path')
+    parser.add_argument('package', nargs='*', help='package file path')
     parser.add_argument('--threshold', type=int, help='set threshold')
+    parser.add_argument('--config',
+                        help='read threshold of project-branch from config '
+                        'file (see threshold_tuner.py)')
     parser.add_argument('--no-clean',
                         help='not clean upload folder',
                         action='store_true')
+    parser.add_argument('--pack',
+                        help='store blocks in pack files',
+                        action='store_true')
+    parser.add_argument('--blocks-folder',
+                        help='blocks folder outside upload folder (never '
+                        'cleaned), concurrent unpackers can share it; '
+                        'upload_example.sh uploads it to <remote>/blocks '
+                        'when BLOCKS_FOLDER is set')
+    parser.add_argument('--fsync', choices=block_store.fsync_policies,
+                        default='none',
+                        help='fsync policy when writing blocks')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='threads for hashing and writing blocks')
+    parser.add_argument('--bundle',
+                        help='create bundle files for small blocks',
+                        action='store_true')
+    parser.add_argument('--chunk-threshold', type=int,
+                        help='split stored files larger than this size '
+                        'into content-defined chunks (except the icon); '
+                        'chunked files have no blocks/<hash>, download them '
+                        'with downloader.py or proxy_server.py instead of '
+                        'pkg_loader.js')
+    parser.add_argument('--chunk-deflated',
+                        help='also split deflated files into chunks',
+                        action='store_true')
+    parser.add_argument('--codec', choices=block_codec.codecs[1:],
+                        help='compress blocks of stored files (except the '
+                        'icon); encoded blocks need downloader.py or '
+                        'proxy_server.py, pkg_loader.js reads raw blocks')
+    parser.add_argument('--delta-base',
+                        help='previous build package, create delta blocks '
+                        'of changed files against it')
+    parser.add_argument('--uploaded',
+                        help='inventory of uploaded blocks, skip writing them '
+                        'and list new files for rclone --files-from')
+    parser.add_argument('--files-list', default='upload_files.txt',
+                        help='new files list path (with --uploaded)')
+    parser.add_argument('--metrics',
+                        help='write metrics report to json file, '
+                        'or a json line to fd:<n>')
 
     blocks_only_group = parser.add_argument_group(
         title='Blocks only options')
@@ -207,25 +550,90 @@ if __name__ == '__main__':
                               action='store_true')
     by_git_group.add_argument('--tag', help='addition tag')
 
+    batch_group = parser.add_argument_group(
+        title='Batch options (by git commit info)')
+    batch_group.add_argument('--batch',
+                             help='json file of packages: [{"package": path, '
+                             '"tag": tag, "delta_base": path}, ...]')
+    batch_group.add_argument('-p', '--processes', type=int,
+                             help='batch mode process count')
+
     args = parser.parse_args()
 
-    # 设置 threshold
+    # 设置 threshold（命令行优先，其次为配置文件中项目-分支的推荐值）
     if args.threshold != None:
         zip_utils.threshold = args.threshold
+    elif args.config != None:
+        branch = None
+        if args.project != None:
+            branch = get_commit(args)['branch']
+        threshold = threshold_tuner.load_threshold(args.config, args.project,
+                                                   branch)
+        if threshold != None:
+            zip_utils.threshold = threshold
+            print('threshold => %d' % threshold)
+    # 设置分块
+    chunker.threshold = args.chunk_threshold
+    chunker.stored_only = not args.chunk_deflated
+    # 设置块编码，图标由网页直接读取，不编码
+    block_codec.codec = args.codec
+    zip_shrink.raw_names.add(icon_name)
+    block_store.fsync = args.fsync
+    # 统计
+    if args.metrics != None:
+        metrics.enable('unpacker')
 
     # 构建包
-    pkg_path = args.package
+    if args.batch != None:
+        items = read_json(args.batch)
+    else:
+        items = [{'package': x, 'tag': args.tag} for x in args.package]
+    if len(items) == 0:
+        parser.error('no package')
+    if len(items) > 1 and args.blocks_only:
+        parser.error('batch mode needs git commit info')
+    if args.uploaded != None and (args.pack or len(items) > 1 or
+                                  args.batch != None):
+        parser.error('--uploaded supports single package with loose blocks')
+
+    # 上一次运行的新增文件列表已过时（本次不是增量上传时不再生成）
+    if os.path.exists(args.files_list):
+        os.remove(args.files_list)
+
     # 基本目录结构
+    # 块目录可以放在 upload 之外，由多个并行的构建任务共用，不随 upload 清理
+    # 新增文件列表中块的路径仍为 blocks/<name>（相对远端），由上传脚本从块目录上传
     base_folder = 'upload'
-    blocks_folder = os.path.join(base_folder, 'blocks')
+    blocks_folder = args.blocks_folder
+    if blocks_folder == None:
+        blocks_folder = os.path.join(base_folder, 'blocks')
     if not args.no_clean:
         if os.path.exists(base_folder):
             shutil.rmtree(base_folder)
+    mkdirs(base_folder)
     mkdirs(blocks_folder)
+    store = block_store.get_store(blocks_folder, pack=args.pack)
+    # 增量上传
+    if args.uploaded != None:
+        store = upload_set.UploadedStore(
+            store, upload_set.read_inventory(args.uploaded))
+        upload_set.enable()
 
     if args.blocks_only:
-        unpack_blocks_only(pkg_path, base_folder, blocks_folder, args.shrink_pkg_name)
+        unpack_blocks_only(items[0]['package'], base_folder, store,
+                           args.shrink_pkg_name, args.bundle, args.jobs,
+                           args.delta_base)
+    elif len(items) > 1 or args.batch != None:
+        unpack_batch(items, base_folder, blocks_folder, args)
     else:
-        unpack_by_git(pkg_path, base_folder, blocks_folder, args)
+        unpack_by_git(items[0]['package'], base_folder, store, args)
+
+    if args.uploaded != None:
+        files = upload_set.write_files_list(base_folder, args.files_list,
+                                            store)
+        print('%d new files => %s' % (len(files), args.files_list))
+
+    if args.metrics != None:
+        write_metrics(args.metrics)
 
     print('success')
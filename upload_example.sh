@@ -1,7 +1,25 @@
-# usage: <upload.sh path> <remote_name:bucket_name>
+# usage: <upload.sh path> <remote_name:bucket_name> [files list]
+# 增量上传时传入 unpacker.py --uploaded uploaded.txt 生成的新增文件列表（默认 upload_files.txt）
+# 块目录不在 upload 下（unpacker.py --blocks-folder）时设置环境变量 BLOCKS_FOLDER
 
 prefix=${prefix%-20*}
 if [ -n "$prefix" ]; then 
     <rclone_path> delete $1 --include "$prefix*" || 0
 fi
-<rclone_path> copy upload/ $1 --progress
\ No newline at end of file
+
+blocks=${BLOCKS_FOLDER:-upload/blocks}
+
+if [ -n "$2" ]; then
+    # 只上传新增文件，不遍历远端；先上传块，精简包可见时引用的块都已上传
+    # 成功后把新增的块追加到已上传清单，并删除列表
+    grep '^blocks/' $2 | sed 's#^blocks/##' > $2.blocks
+    grep -v '^blocks/' $2 > $2.others
+    <rclone_path> copy $blocks $1/blocks --files-from $2.blocks --no-traverse --progress && \
+    <rclone_path> copy upload/ $1 --files-from $2.others --no-traverse --progress && \
+        { cat $2.blocks >> uploaded.txt; rm $2 $2.blocks $2.others; }
+else
+    if [ -n "$BLOCKS_FOLDER" ]; then
+        <rclone_path> copy $BLOCKS_FOLDER $1/blocks --exclude ".index" --exclude "*.tmp" --progress
+    fi
+    <rclone_path> copy upload/ $1 --exclude ".index" --exclude ".gc/**" --progress
+fi
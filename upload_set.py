@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import hashlib
+import zip_utils
+import zip_repack
+import block_store
+import block_codec
+
+'''
+增量上传
+
+已上传的块清单（例如 rclone lsf <remote>/blocks 的输出，或每次上传成功后追加的列表），
+每行一个文件名 <md5> 或 <md5>.chunks，也可以带 blocks/ 前缀
+
+拆分时清单中的块视为已存在，不再写入 upload 目录；
+校验、生成 bundle 和差量时，缺少的块从原始包中读取
+
+拆分完成后写出本次新增文件的列表（相对 upload 目录），
+上传时使用 rclone copy --files-from，远端操作次数只与新增文件数有关
+    块          本次精简包引用的、不在已上传清单中的块和分块清单
+    其他文件    本次写入的精简包、清单、bundle、差量、meta、提交信息（写入时由 record 记录）
+'''
+
+# 本次写入的文件（开启增量上传时为 list，见 enable）
+written = None
+# 本次生成的精简包引用的块
+referenced = None
+
+
+def enable():
+    global written, referenced
+    written = []
+    referenced = set()
+
+
+def record(*paths):
+    ''' 记录本次写入的文件（未开启增量上传时直接返回） '''
+    if written != None:
+        written.extend(paths)
+
+
+def record_package(path):
+    ''' 记录精简包及其引用的块（精简包之后可能被删除，立即解析） '''
+    if written == None:
+        return
+    written.append(path)
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    for data, hash, f in zip_repack.iter_segments(
+            buffer[:-zip_utils.hash_len]):
+        if hash != None:
+            referenced.add(hash)
+
+
+def read_inventory(path):
+    ''' 读取已上传的块清单 '''
+    names = set()
+    if not os.path.exists(path):
+        return names
+    with open(path, 'r') as f:
+        for line in f:
+            name = os.path.basename(line.strip())
+            if name:
+                names.add(name)
+    return names
+
+
+class UploadedStore(object):
+    ''' 已上传的块视为已存在，只写入新块
+        已上传的分块清单不视为已存在：分块清单很小，重新写入本地，
+        生成清单（pkg_manifest）时才能记录分块列表，已上传的分块本身不会重复写入
+    '''
+
+    def __init__(self, store, uploaded):
+        self.store = store
+        self.uploaded = uploaded
+        self.folder = store.folder
+
+    def __contains__(self, hash):
+        return hash in self.store or hash in self.uploaded
+
+    def add(self, hash, data):
+        if hash in self.uploaded:
+            return False
+        return self.store.add(hash, data)
+
+
+class SourceStore(object):
+    ''' 优先从本地块存储读取，本地没有的文件内容从原始包中读取 '''
+
+    def __init__(self, src_path, store):
+        self.store = store
+        self.folder = store.folder
+        with open(src_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # hash -> (内容偏移, 大小)，只在本地没有时计算 hash
+        self.entries = {}
+        self.pending = list(zip_utils.get_file_infos(self.mm))
+
+    def close(self):
+        self.mm.close()
+
+    def load(self):
+        for f in self.pending:
+            offset = f.header_offset + zip_utils.get_header_len(
+                self.mm, f.header_offset)
+            data = self.mm[offset:offset+f.compressed_size]
+            self.entries[hashlib.md5(data).hexdigest()] = (
+                offset, f.compressed_size)
+        self.pending = []
+
+    def source(self, hash):
+        if self.pending:
+            self.load()
+        return self.entries.get(hash)
+
+    def __contains__(self, hash):
+        return hash in self.store or self.source(hash) != None
+
+    def read(self, hash):
+        ''' 原始包中的内容（编码为块格式，见 block_codec） '''
+        offset, size = self.source(hash)
+        return block_codec.encode(self.mm[offset:offset+size], False)
+
+    def size(self, hash):
+        if hash in self.store:
+            return self.store.size(hash)
+        return len(self.read(hash))
+
+    def iter_data(self, hash, view):
+        if hash in self.store:
+            return self.store.iter_data(hash, view)
+        return iter([self.read(hash)])
+
+
+def get_check_store(store, src_path):
+    ''' 校验等需要读取块内容时使用的存储 '''
+    if isinstance(store, UploadedStore):
+        return SourceStore(src_path, store.store)
+    return store
+
+
+def new_blocks(store):
+    ''' 引用的块中不在已上传清单中的块文件名（分块存储的文件内容为分块清单和各分块） '''
+    uploaded = store.uploaded
+    names = set()
+    for hash in referenced:
+        if hash in uploaded:
+            continue
+        if hash in store.store:
+            names.add(hash)
+        chunks = block_store.read_recipe(store.store, hash)
+        if chunks == None:
+            continue
+        if hash + block_store.recipe_ext not in uploaded:
+            names.add(hash + block_store.recipe_ext)
+        names.update(h for h, size in chunks if h not in uploaded)
+    return sorted(names)
+
+
+def write_files_list(base_folder, path, store):
+    ''' 写出新增文件列表
+    Args:
+        base_folder: upload 目录
+        path:        列表文件路径
+        store:       UploadedStore
+    Returns:
+        新增文件列表（相对 upload 目录）
+    '''
+
+    files = ['blocks/' + name for name in new_blocks(store)]
+    for x in sorted(set(written)):
+        if os.path.exists(x):
+            files.append(os.path.relpath(x, base_folder).replace(os.sep, '/'))
+
+    with open(path, 'w') as f:
+        for name in files:
+            f.write(name + '\n')
+    return files
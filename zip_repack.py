@@ -1,29 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
+import hashlib
 import zip_utils
+import block_store
 
 
-def repack(src_path, dst_path, item_folder):
-    ''' 将精简后的 zip 恢复
-    Args:
-        src_path:    精简后的 zip 包路径
-        dst_path:    恢复后的 zip 包路径
-        item_folder: 文件内容存储路径
-    '''
+# 拷贝文件内容时的缓冲区大小
+copy_buffer_size = 1024 * 1024
 
-    # 打开文件
-    with open(src_path, 'rb') as f:
-        buffer = f.read()
 
-    # 抽取原始压缩文件 hash
-    buffer = buffer[:-zip_utils.hash_len]
-
-    file_infos = zip_utils.get_file_infos(buffer)
+def iter_segments(buffer, entries=None):
+    ''' 按输出顺序遍历精简后的 zip（不含末尾的原始压缩文件 hash）
+    Args:
+        buffer:  精简后的 zip 包二进制
+        entries: 清单中的文件项（见 pkg_manifest），传入时不再解析中央目录
+    Yields:
+        (data, hash, file_info): 直接写出的数据，以及其后需要从块存储读取的文件内容
+                                 最后一项为尾部数据，hash 和 file_info 为 None
+    '''
 
-    # 准备输出文件
-    dst = open(dst_path, 'wb')
+    view = memoryview(buffer)
+    if entries != None:
+        file_infos = entries
+    else:
+        file_infos = zip_utils.get_file_infos(buffer)
 
     # 光标，记录上一次处理到的位置
     cursor = 0
@@ -31,26 +32,74 @@ def repack(src_path, dst_path, item_folder):
     ex_size = 0
     # 遍历所有文件
     for f in file_infos:
-        header_offset = f.header_offset - ex_size
-        offset = (header_offset +
-                  zip_utils.get_header_len(buffer, header_offset))
-        # 写入 cursor 到 offset 之间的数据
-        dst.write(buffer[cursor:offset])
+        if entries != None:
+            # 清单中记录了内容在原始包中的偏移和 hash
+            offset = f.offset - ex_size
+            hash = f.hash
+        else:
+            header_offset = f.header_offset - ex_size
+            offset = (header_offset +
+                      zip_utils.get_header_len(buffer, header_offset))
 
-        # 读取记录的内容 hash
-        hash = buffer[offset:offset+zip_utils.hash_len].hex()
+            # 读取记录的内容 hash
+            hash = buffer[offset:offset+zip_utils.hash_len].hex()
 
-        # 读取内容并写入恢复文件
-        path = os.path.join(item_folder, hash)
-        with open(path, 'rb') as file:
-            dst.write(file.read())
+        # cursor 到 offset 之间的数据
+        yield view[cursor:offset], hash, f
 
         # 光标置于文件内容区（此时为 hash）末尾
         cursor = offset + zip_utils.hash_len
         # 偏移修正
         ex_size += f.compressed_size - zip_utils.hash_len
 
-    # 写入尾部内容
-    dst.write(buffer[cursor:])
+    # 尾部内容
+    yield view[cursor:], None, None
+
+
+def repack(src_path, dst_path, item_folder, manifest=None):
+    ''' 将精简后的 zip 恢复，写入的同时计算 md5，无需再次读取输出文件校验
+    Args:
+        src_path:    精简后的 zip 包路径
+        dst_path:    恢复后的 zip 包路径（只校验时可以传 os.devnull）
+        item_folder: 文件内容存储路径（或已打开的块存储）
+        manifest:    精简包的清单（见 pkg_manifest），传入时不再解析中央目录
+    Returns:
+        恢复后 zip 包的 md5
+    '''
+
+    store = block_store.get_store(item_folder)
+
+    # 打开文件（精简包只包含头结构和小文件，可以整体读入）
+    with open(src_path, 'rb') as f:
+        buffer = f.read()
+
+    # 抽取原始压缩文件 hash
+    buffer = buffer[:-zip_utils.hash_len]
+
+    # 输出内容 hash
+    m = hashlib.md5()
+    # 拷贝缓冲区
+    copy_view = memoryview(bytearray(copy_buffer_size))
+
+    # 准备输出文件
+    dst = open(dst_path, 'wb')
+
+    def write(data):
+        m.update(data)
+        dst.write(data)
+
+    entries = manifest.entries if manifest != None else None
+    for data, hash, f in iter_segments(buffer, entries):
+        # 写入头结构等数据
+        write(data)
+        if hash == None:
+            continue
+
+        # 读取内容并写入恢复文件
+        for data in block_store.iter_entry_data(store, hash, copy_view):
+            write(data)
+
     # 关闭文件
     dst.close()
+
+    return m.digest()
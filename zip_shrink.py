@@ -2,26 +2,106 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
 import hashlib
 import zip_utils
+import block_store
+import chunker
+import block_codec
+import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-def shrink(src_path, dst_path, item_folder, content_monitor=None):
+# 每个工作线程预先提交的文件数
+prefetch_per_worker = 4
+# 网页端（pkg_loader.js、index.html）直接读取的文件名，块保存原始内容，不按 codec 编码也不分块
+raw_names = set()
+
+
+def shrink(src_path, dst_path, item_folder, content_monitor=None, workers=1):
     ''' 将原始 zip 包拆分存储
     Args:
         src_path:    原始 zip 包路径
         dst_path:    精简后的 zip 包路径
-        item_folder: 文件内容存储路径
+        item_folder: 文件内容存储路径（或已打开的块存储）
+        workers:     计算文件内容 hash 和写入块的线程数
     '''
 
-    # 打开源文件
+    store = block_store.get_store(item_folder)
+
+    # 以 mmap 方式打开源文件，不整体读入内存，峰值内存约为单个文件内容大小
     with open(src_path, 'rb') as f:
-        buffer = f.read()
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    # 通过 memoryview 切片，避免拷贝
+    buffer = memoryview(mm)
+
+    try:
+        with ThreadPoolExecutor(workers) as pool, open(dst_path, 'wb') as dst:
+            return _shrink(mm, buffer, dst, store, content_monitor,
+                           pool, workers * prefetch_per_worker)
+    except BaseException:
+        # 删除不完整的精简包
+        if dst_path != os.devnull and os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise
+    finally:
+        buffer.release()
+        try:
+            mm.close()
+        except BufferError:
+            # 异常退出时切片可能仍被 traceback 引用，交给 GC 回收
+            pass
+
+
+def get_digest(data):
+    with metrics.phase('hash'):
+        return hashlib.md5(data).digest()
+
+
+def add_block(store, hash, data, f_info):
+    ''' 编码并写入块，只压缩未压缩（stored）的文件内容 '''
+    with metrics.phase('block_write'):
+        data = block_codec.encode(
+            data, f_info.method == 0 and f_info.name not in raw_names)
+        added = store.add(hash, data)
+    if added:
+        metrics.add('blocks_new')
+        metrics.add('blocks_new_bytes', f_info.compressed_size)
+        metrics.add('block_bytes_written', len(data))
+    return added
+
+
+def add_chunks(store, hash, data):
+    with metrics.phase('block_write'):
+        return chunker.add_chunks(store, hash, data)
+
+
+def _shrink(mm, buffer, dst, store, content_monitor, pool, prefetch):
+    ''' 文件内容的 hash 计算和块写入在线程池中并行（hashlib 处理大数据时会释放 GIL），
+        主线程按顺序计算源文件整体 hash、写出精简包、回调 content_monitor
+    '''
 
-    file_infos = zip_utils.get_file_infos(buffer)
+    with metrics.phase('parse'):
+        file_infos = iter(zip_utils.get_file_infos(mm))
 
-    # 准备输出文件
-    dst = open(dst_path, 'wb')
+    # 已提交计算 hash 的文件 (文件信息, 内容偏移, 内容, hash future)
+    pending = deque()
+
+    def submit_next():
+        f = next(file_infos, None)
+        if f == None:
+            return
+        # 计算偏移
+        offset = (f.header_offset +
+                  zip_utils.get_header_len(mm, f.header_offset))
+        data = buffer[offset:offset+f.compressed_size]
+        pending.append((f, offset, data, pool.submit(get_digest, data)))
+
+    for i in range(prefetch):
+        submit_next()
 
     # 源文件整体 hash
     src_m = hashlib.md5()
@@ -34,37 +114,42 @@ def shrink(src_path, dst_path, item_folder, content_monitor=None):
         if append:
             dst.write(data)
 
+    # 已提交写入的块
+    writing = set()
+    writes = []
+
     # 光标，记录上一次处理到的位置
     cursor = 0
-    # 遍历所有文件
-    for f in file_infos:
-        # 计算偏移
-        offset = (f.header_offset +
-                  zip_utils.get_header_len(buffer, f.header_offset))
+    # 按偏移顺序处理所有文件
+    while pending:
+        f, offset, data, future = pending.popleft()
+        submit_next()
 
         # 处理上一个处理位置到此头结构末尾的部分
         handle_seg(buffer[cursor:offset])
 
         # 处理文件内容
-        data = buffer[offset:offset+f.compressed_size]
         handle_seg(data, append=False)
 
-        # 计算文件内容 hash
-        m = hashlib.md5()
-        m.update(data)
-        hash = m.hexdigest()
+        # 文件内容 hash
+        digest = future.result()
+        hash = digest.hex()
 
-        # 写内容到文件
-        path = os.path.join(item_folder, hash)
-        if item_folder != '/dev/null' and not os.path.exists(path):
-            with open(path, 'wb') as file:
-                file.write(data)
+        # 写内容到块存储（已存在则跳过），大文件按内容分块写入
+        metrics.add('entries')
+        metrics.add('entries_bytes', f.compressed_size)
+        if store != None and hash not in store and hash not in writing:
+            writing.add(hash)
+            if not chunker.should_chunk(f) or f.name in raw_names:
+                writes.append(pool.submit(add_block, store, hash, data, f))
+            elif not block_store.has_entry(store, hash):
+                writes.append(pool.submit(add_chunks, store, hash, data))
 
         if content_monitor != None:
             content_monitor(f, hash)
 
         # 记录 hash
-        dst.write(m.digest())
+        dst.write(digest)
 
         # 光标置于文件内容区末尾
         cursor = offset + f.compressed_size
@@ -74,8 +159,11 @@ def shrink(src_path, dst_path, item_folder, content_monitor=None):
     # 写入源文件 hash
     hash = src_m.digest()
     dst.write(hash)
+    metrics.add('bytes_read', len(mm))
+    metrics.add('shrink_bytes_written', dst.tell())
 
-    # 关闭文件
-    dst.close()
+    # 等待块写入完成（有异常时抛出）
+    for w in writes:
+        w.result()
 
     return hash
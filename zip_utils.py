@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import struct
+from array import array
 
 
 # 内容抽出的阈值，先用 4k 试试，参考文件读写经验数值
 threshold = 4096
 # md5 hash 长度
 hash_len = 16
+# zip64 扩展区 header id，以及 32 位字段用来表示"值在 zip64 扩展区中"的标记值
+zip64_extra_id = 0x0001
+zip64_mask_16 = 0xffff
+zip64_mask_32 = 0xffffffff
 
 '''
 参考资源
@@ -39,10 +44,16 @@ class FileInfo(object):
         file name (variable size)
         extra field (variable size)
         file comment (variable size)
+
+    压缩后大小或文件头偏移为 0xffffffff 时，实际值在扩展区的 zip64 扩展项中（见 read_zip64_extra）
     '''
 
+    __slots__ = ('match_sign', 'method', 'compressed_size', 'name',
+                 'header_offset', 'info_len')
+
     struct_sign = '<4s6H3L5H2L'
-    fixed_len = struct.calcsize(struct_sign)
+    header = struct.Struct(struct_sign)
+    fixed_len = header.size
     sign = b'PK\001\002'
 
     def __init__(self, buffer, offset):
@@ -50,15 +61,117 @@ class FileInfo(object):
         if not self.match_sign:
             return
 
-        data = struct.unpack(self.struct_sign,
-                             buffer[offset:offset+self.fixed_len])
-        self.compressed_size = data[8]
+        data = self.header.unpack_from(buffer, offset)
+        self.method = data[4]
         name_len = data[10]
-        self.name = buffer[offset+self.fixed_len:
-                           offset+self.fixed_len+name_len].decode('utf-8')
-        self.header_offset = data[16]
+        self.name = bytes(buffer[offset+self.fixed_len:
+                                 offset+self.fixed_len+name_len]).decode('utf-8')
+        self.compressed_size, self.header_offset = read_zip64_extra(
+            buffer, offset + self.fixed_len + name_len, data)
         self.info_len = self.fixed_len + name_len + data[11] + data[12]
 
+    @classmethod
+    def make(cls, name, method, compressed_size, header_offset):
+        f = cls.__new__(cls)
+        f.match_sign = True
+        f.name = name
+        f.method = method
+        f.compressed_size = compressed_size
+        f.header_offset = header_offset
+        return f
+
+
+class Directory(object):
+    ''' 中央目录中需要处理的文件信息，列式存储（并行数组）
+        遍历或下标访问时生成 FileInfo，用法与 FileInfo 列表一致
+    '''
+
+    def __init__(self):
+        self.names = []
+        self.methods = array('H')
+        self.compressed_sizes = array('Q')
+        self.header_offsets = array('Q')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(len(self)))]
+        return FileInfo.make(self.names[i], self.methods[i],
+                             self.compressed_sizes[i], self.header_offsets[i])
+
+    def __iter__(self):
+        for x in zip(self.names, self.methods, self.compressed_sizes,
+                     self.header_offsets):
+            yield FileInfo.make(*x)
+
+    def append(self, name, method, compressed_size, header_offset):
+        self.names.append(name)
+        self.methods.append(method)
+        self.compressed_sizes.append(compressed_size)
+        self.header_offsets.append(header_offset)
+
+    def sort(self):
+        ''' 按偏移量排序 '''
+        offsets = self.header_offsets
+        if all(offsets[i] < offsets[i+1] for i in range(len(offsets) - 1)):
+            return
+
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        self.names = [self.names[i] for i in order]
+        self.methods = array('H', (self.methods[i] for i in order))
+        self.compressed_sizes = array(
+            'Q', (self.compressed_sizes[i] for i in order))
+        self.header_offsets = array('Q', (offsets[i] for i in order))
+
+
+def read_zip64_extra(buffer, extra_offset, data):
+    ''' 读取中央目录文件信息的压缩后大小和文件头偏移（处理 zip64 扩展项）
+
+    Zip64 extended information extra field
+
+    0   header id                       2 bytes  (0x0001)
+    1   size of this extra block        2 bytes
+        original size                   8 bytes  (仅当 uncompressed size 为 0xffffffff)
+        compressed size                 8 bytes  (仅当 compressed size 为 0xffffffff)
+        relative header offset          8 bytes  (仅当 offset 为 0xffffffff)
+        disk start number               4 bytes  (仅当 disk number 为 0xffff)
+
+    Args:
+        buffer:       源文件字节数组
+        extra_offset: 扩展区偏移
+        data:         FileInfo.header 解析出的字段
+    Returns:
+        (压缩后大小, 文件头偏移)
+    '''
+
+    compressed_size = data[8]
+    header_offset = data[16]
+    if compressed_size != zip64_mask_32 and header_offset != zip64_mask_32:
+        return compressed_size, header_offset
+
+    offset = extra_offset
+    end = extra_offset + data[11]
+    while offset + 4 <= end:
+        id, size = struct.unpack_from('<2H', buffer, offset)
+        offset += 4
+        if id != zip64_extra_id:
+            offset += size
+            continue
+
+        # 字段按固定顺序出现，只包含 32 位字段为标记值的项
+        if data[9] == zip64_mask_32:
+            offset += 8
+        if compressed_size == zip64_mask_32:
+            compressed_size = struct.unpack_from('<Q', buffer, offset)[0]
+            offset += 8
+        if header_offset == zip64_mask_32:
+            header_offset = struct.unpack_from('<Q', buffer, offset)[0]
+        break
+
+    return compressed_size, header_offset
+
 
 def parse_directory(buffer, dir_offset, dir_size):
     ''' 遍历中央目录中的所有文件信息
@@ -68,15 +181,30 @@ def parse_directory(buffer, dir_offset, dir_size):
         dir_size: 中央目录大小
     '''
 
-    file_infos = []
+    # 记录是变长的（文件名、扩展区、注释），无法整体 iter_unpack
+    # 用 unpack_from 直接在原缓冲区上解析，不产生切片拷贝，只解码需要保留的文件名
+    unpack_from = FileInfo.header.unpack_from
+    fixed_len = FileInfo.fixed_len
+
+    file_infos = Directory()
     offset = dir_offset
     end = dir_offset + dir_size
     while offset < end:
-        f = FileInfo(buffer, offset)
-        # 过滤掉小于 4k 的文件
-        if (f.compressed_size > threshold):
-            file_infos.append(f)
-        offset += f.info_len
+        data = unpack_from(buffer, offset)
+        name_len = data[10]
+        # 过滤掉小于 4k 的文件（zip64 的标记值 0xffffffff 也大于阈值，读取扩展项后再判断）
+        if data[8] > threshold:
+            compressed_size, header_offset = data[8], data[16]
+            if compressed_size == zip64_mask_32 or \
+                    header_offset == zip64_mask_32:
+                compressed_size, header_offset = read_zip64_extra(
+                    buffer, offset + fixed_len + name_len, data)
+            if compressed_size > threshold:
+                name = bytes(buffer[offset+fixed_len:
+                                    offset+fixed_len+name_len]).decode('utf-8')
+                file_infos.append(name, data[4], compressed_size,
+                                  header_offset)
+        offset += fixed_len + name_len + data[11] + data[12]
 
     # 按偏移量排序（中央目录不保证顺序，但不会有两个文件共用存储，结构上就不支持）
     '''
@@ -84,13 +212,13 @@ def parse_directory(buffer, dir_offset, dir_size):
     The order of the file entries in the central directory 
     need not coincide with the order of file entries in the archive
     '''
-    file_infos.sort(key=lambda x: x.header_offset)
+    file_infos.sort()
     return file_infos
 
 
 def parse_EOCD(buffer):
-    ''' 解析中央目录结束标记，返回中央目录偏移和大小
-        重点: **中央目录中文件信息是连续的，且其后紧跟结束标记（zip64 除外，本项目暂不支持 zip64）**
+    ''' 解析中央目录结束标记，返回中央目录大小和偏移
+        重点: **中央目录中文件信息是连续的，且其后紧跟结束标记（zip64 时紧跟 zip64 结束记录）**
         因为中央目录结束标记中记录的中央目录偏移是针对文件头的编译
         所以精简版 zip 这个偏移无法命中，也无法计算（需要先解析中央目录）
         只能这样计算: 中央目录结束标记偏移 - 目录大小
@@ -112,23 +240,95 @@ def parse_EOCD(buffer):
     7   .ZIP file comment length        2 bytes
     8   .ZIP file comment               (variable size)
 
+    大于 4G 或超过 65535 个文件时，结束标记前依次为 zip64 结束记录和 zip64 结束记录定位（见 parse_EOCD64）
+
     Args:
         buffer: 源文件字节数组
+    Returns:
+        (中央目录大小, 中央目录偏移)，找不到结束标记时返回 (-1, -1)
     '''
 
     struct_sign = '<4s4H2LH'
     fixed_len = struct.calcsize(struct_sign)
     sign = b'PK\005\006'
 
-    # 起始搜索位置近似值
-    offset = len(buffer) - fixed_len
-    while offset > 0:
-        if buffer[offset:offset+4] != sign:
-            offset -= 1
-            continue
-        data = struct.unpack(struct_sign, buffer[offset:offset+fixed_len])
-        return data[5], offset - data[5]
-    return -1, -1
+    # 从后向前查找标记（bytes 和 mmap 都支持 rfind）
+    offset = buffer.rfind(sign, 1, len(buffer) - fixed_len + 4)
+    if offset < 0:
+        return -1, -1
+
+    zip64 = parse_EOCD64(buffer, offset)
+    if zip64 != None:
+        return zip64
+
+    data = struct.unpack_from(struct_sign, buffer, offset)
+    return data[5], offset - data[5]
+
+
+def parse_EOCD64(buffer, eocd_offset):
+    ''' 解析 zip64 结束记录，返回中央目录大小和偏移，不是 zip64 时返回 None
+        定位中记录的 zip64 结束记录偏移同样是针对原始包的，精简版 zip 无法命中，
+        所以从定位向前查找 zip64 结束记录标记，并校验记录大小与定位位置吻合
+
+    Zip64 end of central directory locator
+
+    0   zip64 end of central dir locator
+        signature                       4 bytes  (0x07064b50)
+    1   number of the disk with the
+        start of the zip64 end of
+        central directory               4 bytes
+    2   relative offset of the zip64
+        end of central directory record 8 bytes
+    3   total number of disks           4 bytes
+
+    Zip64 end of central directory record
+
+    0   zip64 end of central dir
+        signature                       4 bytes  (0x06064b50)
+    1   size of zip64 end of central
+        directory record                8 bytes  (不含前 12 字节)
+    2   version made by                 2 bytes
+    3   version needed to extract       2 bytes
+    4   number of this disk             4 bytes
+    5   number of the disk with the
+        start of the central directory  4 bytes
+    6   total number of entries in the
+        central directory on this disk  8 bytes
+    7   total number of entries in the
+        central directory               8 bytes
+    8   size of the central directory   8 bytes  (中央目录大小)
+    9   offset of start of central
+        directory with respect to
+        the starting disk number        8 bytes
+        zip64 extensible data sector    (variable size)
+
+    Args:
+        buffer:      源文件字节数组
+        eocd_offset: 中央目录结束标记偏移
+    '''
+
+    locator_sign = '<4sLQL'
+    locator_len = struct.calcsize(locator_sign)
+    locator_offset = eocd_offset - locator_len
+    if locator_offset < 0 or \
+            buffer[locator_offset:locator_offset+4] != b'PK\006\007':
+        return None
+
+    struct_sign = '<4sQ2H2L4Q'
+    fixed_len = struct.calcsize(struct_sign)
+    sign = b'PK\006\006'
+
+    # 扩展数据区一般为空，记录紧挨着定位；有扩展数据时继续向前查找
+    end = locator_offset
+    while True:
+        offset = buffer.rfind(sign, 0, end)
+        if offset < 0:
+            return None
+        data = struct.unpack_from(struct_sign, buffer, offset)
+        if offset + 12 + data[1] == locator_offset and \
+                data[1] >= fixed_len - 12:
+            return data[8], offset - data[8]
+        end = offset + 3
 
 
 def get_header_len(buffer, offset):
@@ -148,12 +348,14 @@ def get_header_len(buffer, offset):
 
         file name (variable size)
         extra field (variable size)
+
+    zip64 时大小字段为 0xffffffff，实际大小在扩展区中，
+    内容大小统一以中央目录为准，这里只需要头结构总长度（包含扩展区）
     '''
 
     struct_sign = '<4s5H3L2H'
     fixed_len = struct.calcsize(struct_sign)
-    sign = b'PK\003\004'
-    data = struct.unpack(struct_sign, buffer[offset:offset+fixed_len])
+    data = struct.unpack_from(struct_sign, buffer, offset)
     return fixed_len + data[9] + data[10]
 
 